@@ -3,17 +3,23 @@ qc_pipelines.py
 Holds pipeline scripts for each step of the example QC
 """
 from datetime import date
-from qc_scripts.compare_records import flag_id_date, flag_tester_id, check_location
-from qc_scripts.clean_dataset import update_clean_dataset
+from qc_scripts.compare_records import check_records, check_location, IdDateCheck, TesterIdCheck
+from qc_scripts.clean_dataset import update_clean_dataset, has_staged, skip_staged
 from qc_scripts.destination import get_dst, get_src_dst
-from qc_scripts.duplicates import clean_duplicates, flag_file_count
+from qc_scripts.duplicates import clean_duplicates, flag_file_count, flag_archive_duplicates
+from qc_scripts.integrity import flag_corrupt_audio
 from qc_scripts.move import move_files
+from qc_scripts.probe import probe_audio_metadata
+from qc_scripts.quality import flag_audio_quality, METRIC_KEYS
+from qc_scripts.record_index import RecordIndex
 from qc_scripts.records import pull_redcap, read_csv_records, validate_records
-from qc_scripts.stream import Pipeline, SourceNode, FilterNode, ActionNode
+from qc_scripts.stream import Pipeline, SourceNode, FilterNode, FusedFilterNode, ActionNode
 from qc_scripts.utility import get_latest_data as gld
-from qc_scripts.utility.pattern import example_pattern_data
+from qc_scripts.utility.move_journal import rollback_journal
+from qc_scripts.utility.pattern import example_pattern_data, as_pattern_set
 from qc_scripts.utility.read import read_dictionary_file
 from qc_scripts.walk import match_filename_format, qc_walk
+from qc_scripts.watch import WalkIndex, get_watcher, micro_batches, watch_walk
 from qc_scripts.write_flagged_excel import output_flagged_xlsx
 
 def get_rc_kwargs():
@@ -65,9 +71,9 @@ def pull_records(source='csv', **kwargs):
     else:
         raise ValueError("source must be either 'csv' or 'redcap'")
     
-def walk(**kwargs):
+def get_walk_kwargs(**kwargs):
     """
-    Walks files in given root and separates by passed, pattern mismatch, and wrong extension
+    default walk keyword arguments, updated with kwargs['walk_kwargs']
     """
     walk_kwargs = {
         'roots': ["sample_data/"],
@@ -79,22 +85,37 @@ def walk(**kwargs):
         'ext': 'walk'
     }
     walk_kwargs.update(kwargs.get('walk_kwargs', {}))
+    return walk_kwargs
 
-    (Pipeline('walk_pipeline')
-     .add_node(SourceNode(func=qc_walk, **walk_kwargs))
+def add_probe_node(pipeline, walk_kwargs, probe_kwargs):
+    """
+    Adds probe_audio_metadata for the walk output, unless probe_kwargs['probe'] is False
+    """
+    probe_kwargs = dict({'probe': True, 'ext': walk_kwargs['ext']}, **probe_kwargs)
+    if probe_kwargs.pop('probe'):
+        pipeline.add_node(FilterNode(func=probe_audio_metadata, input_key=walk_kwargs['ext'],
+                                     **probe_kwargs))
+    return pipeline
+
+def walk(**kwargs):
+    """
+    Walks files in given root and separates by passed, pattern mismatch, and wrong extension;
+    the audio metadata of each file is added to its entry
+    """
+    walk_kwargs = get_walk_kwargs(**kwargs)
+
+    add_probe_node(Pipeline('walk_pipeline')
+     .add_node(SourceNode(func=qc_walk, **walk_kwargs)),
+     walk_kwargs, kwargs.get('probe_kwargs', {})
     ).run()
 
-def compare_sources_and_duplicates(**kwargs):
+def get_flag_kwargs(**kwargs):
     """
-    Contains all data filters:
-        - Compares id_date to records
-        - Compares tester_id to records
-        - Checks for duplicates
-        - Checks for too many file occurrences
-        - Compares location to records
-        - Writes file destination path
+    default keyword arguments of the flag nodes, keyed by their name in kwargs
+    (flag_kwargs, integrity_kwargs, quality_kwargs, duplicate_kwargs, archive_duplicate_kwargs)
+    and updated with the ones given there
     """
-    records = read_dictionary_file(gld.get_filepath('records_pipeline_validated_records'))
+    records = RecordIndex(read_dictionary_file(gld.get_filepath('records_pipeline_validated_records')))
 
     flag_kwargs = {
         'record_end_date': date.today(),
@@ -110,15 +131,95 @@ def compare_sources_and_duplicates(**kwargs):
     }
     duplicate_kwargs.update(kwargs.get('duplicate_kwargs', {}))
 
+    archive_duplicate_kwargs = {
+        'clean_dataset': gld.get_filepath('clean_dataset')
+    }
+    archive_duplicate_kwargs.update(kwargs.get('archive_duplicate_kwargs', {}))
+
+    integrity_kwargs = {
+        'check': True,
+        'ext': 'corrupt_audio'
+    }
+    integrity_kwargs.update(kwargs.get('integrity_kwargs', {}))
+
+    quality_kwargs = {
+        'max_silence_ratio': 0.9,
+        'max_clipping_ratio': 0.001,
+        'min_rms_dbfs': -50.0,
+        'check': True,
+        'ext': 'flagged_quality'
+    }
+    quality_kwargs.update(kwargs.get('quality_kwargs', {}))
+
+    ## the integrity check decodes every file; the quality metrics and fingerprint
+    ## energies are computed in the same pass so later nodes do not decode them again
+    if quality_kwargs['check']:
+        integrity_kwargs.setdefault('measure', {k: v for k, v in quality_kwargs.items()
+                                                if k in METRIC_KEYS})
+    if duplicate_kwargs.get('compare_fingerprint', False):
+        integrity_kwargs.setdefault('fingerprint', {})
+    return {'flag_kwargs': flag_kwargs,
+            'integrity_kwargs': integrity_kwargs,
+            'quality_kwargs': quality_kwargs,
+            'duplicate_kwargs': duplicate_kwargs,
+            'archive_duplicate_kwargs': archive_duplicate_kwargs}
 
-    (Pipeline('flag_pipeline')
-        .update_state('walk_passed', gld.get_filepath('walk_pipeline_walk'))
-        .add_node(FilterNode(func=flag_id_date, input_key='walk_passed', write_output_func=output_flagged_xlsx,**flag_kwargs))
-        .add_node(FilterNode(func=flag_tester_id, write_output_func=output_flagged_xlsx, **flag_kwargs))
-        .add_node(FilterNode(func=clean_duplicates, **duplicate_kwargs))
+def add_flag_nodes(pipeline, node_kwargs):
+    """
+    Adds the data filters of compare_sources_and_duplicates to a pipeline
+    that has the walk output in its 'walk_passed' state;
+    node_kwargs comes from get_flag_kwargs(); the integrity and quality checks (which
+    decode every file) are left out if their 'check' is False
+    """
+    flag_kwargs = node_kwargs['flag_kwargs']
+    integrity_kwargs = dict(node_kwargs['integrity_kwargs'])
+    quality_kwargs = dict(node_kwargs['quality_kwargs'])
+    clean_dataset = node_kwargs['archive_duplicate_kwargs']['clean_dataset']
+    ## originals a staged run left in place are taken out first (only if the clean
+    ## dataset has staged entries); id_date and tester_id are checked in one pass;
+    ## location is checked after the duplicate and file count filters, as it changes
+    ## which files they see
+    input_key = 'walk_passed'
+    if has_staged(clean_dataset):
+        pipeline.add_node(FilterNode(func=skip_staged, input_key=input_key,
+                                     clean_dataset=clean_dataset))
+        input_key = 'passed'
+    pipeline.add_node(FusedFilterNode(func=check_records, input_key=input_key,
+                                      write_output_func=output_flagged_xlsx,
+                                      checks=[IdDateCheck, TesterIdCheck], **flag_kwargs))
+    if integrity_kwargs.pop('check'):
+        pipeline.add_node(FilterNode(func=flag_corrupt_audio, write_output_func=output_flagged_xlsx,
+                                     **integrity_kwargs))
+    if quality_kwargs.pop('check'):
+        pipeline.add_node(FilterNode(func=flag_audio_quality, write_output_func=output_flagged_xlsx,
+                                     **quality_kwargs))
+    return (pipeline
+        .add_node(FilterNode(func=clean_duplicates, **node_kwargs['duplicate_kwargs']))
+        .add_node(FilterNode(func=flag_archive_duplicates, write_output_func=output_flagged_xlsx,
+                             **node_kwargs['archive_duplicate_kwargs']))
         .add_node(FilterNode(func=flag_file_count))
         .add_node(FilterNode(func=check_location, **{'records': flag_kwargs['records']}))
-        .add_node(FilterNode(func=get_dst))
+        .add_node(FilterNode(func=get_dst)))
+
+def compare_sources_and_duplicates(**kwargs):
+    """
+    Contains all data filters:
+        - Skips the originals of files a staged run already added to the clean dataset
+        - Compares id_date to records
+        - Compares tester_id to records
+        - Checks that audio files decode all the way through
+        - Checks for silent, clipped or quiet recordings
+        - Checks for duplicates
+        - Checks for duplicates in other id_dates and the clean dataset
+        - Checks for too many file occurrences
+        - Compares location to records
+        - Writes file destination path
+    """
+    node_kwargs = get_flag_kwargs(**kwargs)
+
+    add_flag_nodes(Pipeline('flag_pipeline')
+        .update_state('walk_passed', gld.get_filepath('walk_pipeline_walk')),
+        node_kwargs
     ).run()
 
 def move_duplicates(**kwargs):
@@ -141,14 +242,18 @@ def move_and_update(**kwargs):
     Moves files to their destinations
     Updates the clean dataset with the files moved
     """
+    ## checksums taken by the move (e.g. checksum_copy) are added to the clean dataset
+    checksums = {}
     move_kwargs = {
         'src_dst_func': get_src_dst,
-        'move_back': False
+        'move_back': False,
+        'checksums': checksums
         }
     move_kwargs.update(kwargs.get('move_kwargs', {}))
 
     clean_kwargs = {
-        'clean_dataset': gld.get_filepath('clean_dataset')
+        'clean_dataset': gld.get_filepath('clean_dataset'),
+        'checksums': checksums
     }
     clean_kwargs.update(kwargs.get('clean_kwargs', {}))
 
@@ -157,3 +262,102 @@ def move_and_update(**kwargs):
      .add_node(ActionNode(func=move_files, input_keys=['flag_pipeline_passed'], **move_kwargs))
      .add_node(ActionNode(func=update_clean_dataset, input_keys=['flag_pipeline_passed'], **clean_kwargs))
     ).run()
+
+def rollback_move(**kwargs):
+    """
+    Moves the files a journaled move finished back to where they were, newest first
+    """
+    rollback_kwargs = {
+        'ext': 'rollback'
+    }
+    rollback_kwargs.update(kwargs.get('rollback_kwargs', {}))
+
+    (Pipeline('rollback_move_pipeline')
+     .add_node(SourceNode(func=rollback_journal, **rollback_kwargs))
+    ).run()
+
+def watch(**kwargs):
+    """
+    Watches the walk roots and sends new recordings through the flag and move pipelines
+    in micro-batches; only the id_date groups of the new files are checked.
+    Runs until interrupted, or for watch_kwargs['max_batches'] batches.
+    Folders files are moved into (e.g. the duplicate_root) should be in the ignore_list
+    if they are under a root.
+    """
+    walk_kwargs = get_walk_kwargs(**kwargs)
+    watch_kwargs = {
+        'batch_window': 5,
+        'poll_interval': 5,
+        'max_batch_size': 1000,
+        'max_batches': None,
+        'process_existing': False,
+        'use_inotify': True
+    }
+    watch_kwargs.update(kwargs.get('watch_kwargs', {}))
+
+    move_kwargs = {
+        'src_dst_func': get_src_dst,
+        'move_back': False
+    }
+    move_kwargs.update(kwargs.get('move_kwargs', {}))
+
+    make_kv_kw = dict(walk_kwargs.get('make_kv_kw', {}), keep_exts=walk_kwargs['keep_exts'])
+    if walk_kwargs.get('pattern_list'):
+        make_kv_kw['pattern_data'] = as_pattern_set(walk_kwargs['pattern_list'])
+    index = WalkIndex(walk_kwargs['make_kv'], make_kv_kw)
+    watcher = get_watcher(walk_kwargs['roots'], ignore_list=walk_kwargs['ignore_list'],
+                          max_workers=walk_kwargs.get('max_workers'),
+                          poll_interval=watch_kwargs['poll_interval'],
+                          use_inotify=watch_kwargs['use_inotify'])
+
+    def run_batch(added, removed):
+        walk_state = add_probe_node(Pipeline('watch_walk_pipeline')
+         .add_node(SourceNode(func=watch_walk, index=index, added=added, removed=removed,
+                              ext=walk_kwargs['ext'])),
+         walk_kwargs, kwargs.get('probe_kwargs', {})
+        ).run()
+        if len(walk_state[walk_kwargs['ext']]) == 0:
+            return
+
+        ## records and the clean dataset may have been updated since the last batch
+        node_kwargs = get_flag_kwargs(**kwargs)
+        flag_state = add_flag_nodes(Pipeline('watch_flag_pipeline')
+            .update_state('walk_passed', walk_state[walk_kwargs['ext']]),
+            node_kwargs
+        ).run()
+
+        (Pipeline('watch_move_duplicates_pipeline')
+            .update_state('duplicates', flag_state.get('duplicates', {}))
+            .add_node(ActionNode(func=move_files, input_keys=['duplicates'], **move_kwargs))
+        ).run()
+
+        checksums = {}
+        clean_kwargs = {
+            'clean_dataset': gld.get_filepath('clean_dataset'),
+            'checksums': checksums
+        }
+        clean_kwargs.update(kwargs.get('clean_kwargs', {}))
+        (Pipeline('watch_move_pipeline')
+         .update_state('flag_pipeline_passed', flag_state.get('passed', {}))
+         .add_node(ActionNode(func=move_files, input_keys=['flag_pipeline_passed'],
+                              **dict(move_kwargs, checksums=checksums)))
+         .add_node(ActionNode(func=update_clean_dataset, input_keys=['flag_pipeline_passed'], **clean_kwargs))
+        ).run()
+
+    try:
+        existing = watcher.start()
+        if watch_kwargs['process_existing']:
+            run_batch(existing, [])
+        else:
+            index.update(existing, [])
+        print(f'Watching {walk_kwargs["roots"]} ({type(watcher).__name__})')
+        batches = micro_batches(watcher, watch_kwargs['batch_window'],
+                                watch_kwargs['max_batch_size'])
+        for count, (added, removed) in enumerate(batches, start=1):
+            run_batch(added, removed)
+            if watch_kwargs['max_batches'] is not None and count >= watch_kwargs['max_batches']:
+                break
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()
@@ -0,0 +1,355 @@
+"""
+audio_scan.py
+One decode pass per file for the steps that read every sample: the integrity check
+(integrity.py), the level metrics (quality.py) and the energy envelope fingerprints are
+made from (fingerprint.py). Each decoded block is handed to every meter that was asked
+for, and the results are kept for the rest of the process (up to MEMO_BYTES) and in
+their own table of the hash cache database, so a file is decoded once however many of
+these steps run.
+"""
+import os
+import json
+import base64
+import struct
+import hashlib
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import soundfile as sf
+from qc_scripts.utility.hash_cache import file_identity, HashCache
+
+## extensions soundfile can decode (e.g. wav, flac, mp3, ogg); other formats are not checked
+SUPPORTED_EXTS = {fmt.lower() for fmt in sf.available_formats()}
+## keywords of LevelMeter and EnvelopeMeter, with their defaults
+MEASURE_DEFAULTS = {'frame_seconds': 0.05, 'silence_dbfs': -60.0, 'clip_level': 0.999}
+FINGERPRINT_DEFAULTS = {'frame_seconds': 0.025}
+## bump when a meter changes, so results cached by an older version are not used
+SCAN_VERSION = 1
+## table of the hash cache database the results are kept in, and its number of rows
+SCAN_TABLE = 'audio_scans'
+SCAN_MAX_ENTRIES = 100000
+## bytes of results kept in this process (an hour of fingerprint energies is ~0.5 MB)
+MEMO_BYTES = 256 * 2 ** 20
+
+def to_dbfs(value):
+    """
+    amplitude (1.0 = full scale) in dBFS; None for silence
+    """
+    return float(20 * np.log10(value)) if value > 0 else None
+
+def riff_truncated(path, file_size):
+    """
+    True if a RIFF (wav) header says the file is longer than it is;
+    libsndfile shortens the frame count of such files without an error
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return False
+    riff_size = struct.unpack('<I', header[4:8])[0]
+    return riff_size + 8 > file_size
+
+class LevelMeter:
+    """
+    RMS and peak level (dBFS), the fraction of samples at or above clip_level and the
+    fraction of frame_seconds frames quieter than silence_dbfs, added up block by block;
+    samples of a frame that straddles two blocks are carried over to the next block
+    """
+    def __init__(self, samplerate, frame_seconds=0.05, silence_dbfs=-60.0, clip_level=0.999):
+        self.frame_length = max(1, int(round(samplerate * frame_seconds)))
+        self.silence_power = 10 ** (silence_dbfs / 10)
+        self.clip_level = clip_level
+        self.sum_squares, self.peak, self.n_clipped, self.n_samples = 0.0, 0.0, 0, 0
+        self.n_silent, self.n_frames = 0, 0
+        self.rest = np.zeros(0)
+
+    def add_frames(self, channel_power):
+        """
+        count the silent frames of per-sample power (averaged across channels)
+        """
+        frame_power = channel_power.reshape(-1, self.frame_length).mean(axis=1)
+        self.n_silent += int(np.count_nonzero(frame_power < self.silence_power))
+        self.n_frames += len(frame_power)
+
+    def add(self, block):
+        """
+        add a (frames, channels) block
+        """
+        magnitude = np.abs(block)
+        power = np.square(block, dtype=np.float64)
+        self.sum_squares += float(power.sum())
+        self.peak = max(self.peak, float(magnitude.max()))
+        self.n_clipped += int(np.count_nonzero(magnitude >= self.clip_level))
+        self.n_samples += block.size
+
+        channel_power = np.concatenate([self.rest, power.mean(axis=1)])
+        n_whole = len(channel_power) // self.frame_length * self.frame_length
+        self.add_frames(channel_power[:n_whole])
+        self.rest = channel_power[n_whole:]
+
+    def result(self):
+        """
+        {'rms_dbfs', 'peak_dbfs', 'clipping_ratio', 'silence_ratio'}; None if there were no samples
+        """
+        if len(self.rest) > 0:
+            ## the last frame may be short
+            self.n_silent += int(self.rest.mean() < self.silence_power)
+            self.n_frames += 1
+            self.rest = np.zeros(0)
+        if self.n_samples == 0:
+            return None
+        return {'rms_dbfs': to_dbfs(np.sqrt(self.sum_squares / self.n_samples)),
+                'peak_dbfs': to_dbfs(self.peak),
+                'clipping_ratio': self.n_clipped / self.n_samples,
+                'silence_ratio': self.n_silent / self.n_frames}
+
+class EnvelopeMeter:
+    """
+    Per-frame energy of the mono mixdown, one value per frame_seconds;
+    a short last frame is dropped
+    """
+    def __init__(self, samplerate, frame_seconds=0.025):
+        self.frame_length = max(1, int(round(samplerate * frame_seconds)))
+        self.energies = []
+        self.rest = np.zeros(0, dtype=np.float32)
+
+    def add(self, block):
+        """
+        add a (frames, channels) block
+        """
+        mono = np.concatenate([self.rest, block.mean(axis=1)])
+        n_whole = len(mono) // self.frame_length * self.frame_length
+        frames = mono[:n_whole].reshape(-1, self.frame_length)
+        self.energies.append(np.square(frames).mean(axis=1))
+        self.rest = mono[n_whole:]
+
+    def result(self):
+        """
+        float32 array of frame energies
+        """
+        if len(self.energies) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(self.energies).astype(np.float32)
+
+def scan_audio(path, block_frames=65536, measure=None, fingerprint=None):
+    """
+    Decodes a file once, block by block (memory stays at one block), and compares the
+    frames decoded to the frame count in its header. measure (LevelMeter keywords) and
+    fingerprint (EnvelopeMeter keywords) add the meters asked for to the same pass.
+    Returns {'integrity': None if the file is intact, else a dictionary with the
+    'integrity_error' (unreadable, zero_length, truncated, decode_error or
+    frame_count_mismatch), 'header_frames', 'decoded_frames' and an 'integrity_message';
+    'quality': LevelMeter result; 'energy': EnvelopeMeter result}. The meters' results
+    are None if the file could not be decoded all the way through (or was not measured).
+    """
+    scanned = {'integrity': None, 'quality': None, 'energy': None}
+    def error(reason, message, header_frames=None, decoded_frames=None):
+        scanned['integrity'] = {'integrity_error': reason, 'integrity_message': message,
+                                'header_frames': header_frames, 'decoded_frames': decoded_frames}
+        return scanned
+
+    try:
+        file_size = os.path.getsize(path)
+    except OSError as e:
+        return error('unreadable', str(e))
+    if file_size == 0:
+        return error('zero_length', 'file is empty')
+    try:
+        f = sf.SoundFile(path)
+    except Exception as e:
+        return error('unreadable', str(e))
+
+    decoded = 0
+    with f:
+        header_frames = f.frames
+        if header_frames == 0:
+            return error('zero_length', 'no audio frames', header_frames, 0)
+        meters = {}
+        if measure is not None:
+            meters['quality'] = LevelMeter(f.samplerate, **measure)
+        if fingerprint is not None:
+            meters['energy'] = EnvelopeMeter(f.samplerate, **fingerprint)
+        buffer = np.empty((block_frames, f.channels), dtype='float32')
+        try:
+            while True:
+                n_frames = len(f.read(out=buffer))
+                if n_frames == 0:
+                    break
+                decoded += n_frames
+                for meter in meters.values():
+                    meter.add(buffer[:n_frames])
+        except Exception as e:
+            return error('decode_error', str(e), header_frames, decoded)
+        scanned.update({part: meter.result() for part, meter in meters.items()})
+
+    if decoded < header_frames:
+        return error('truncated', 'fewer frames than the header', header_frames, decoded)
+    if decoded > header_frames:
+        return error('frame_count_mismatch', 'more frames than the header', header_frames, decoded)
+    if riff_truncated(path, file_size):
+        return error('truncated', 'file is shorter than its RIFF header', header_frames, decoded)
+    return scanned
+
+def part_settings(measure=None, fingerprint=None):
+    """
+    {part: settings} of the results a scan makes; settings are JSON so the same
+    meters with the same keywords share their results
+    """
+    parts = {'integrity': ''}
+    if measure is not None:
+        parts['quality'] = json.dumps(dict(MEASURE_DEFAULTS, **measure), sort_keys=True)
+    if fingerprint is not None:
+        parts['energy'] = json.dumps(dict(FINGERPRINT_DEFAULTS, **fingerprint), sort_keys=True)
+    return parts
+
+def cache_kind(part, settings):
+    """
+    short kind of a part made with settings, e.g. 'energy_v1_3f2a9c1e'
+    """
+    kind = f'{part}_v{SCAN_VERSION}'
+    if settings == '':
+        return kind
+    return f"{kind}_{hashlib.sha1(settings.encode('utf-8')).hexdigest()[:8]}"
+
+def result_bytes(value):
+    """
+    rough size of a scan result in memory
+    """
+    return 256 + (value.nbytes if isinstance(value, np.ndarray) else 0)
+
+class ScanMemo:
+    """
+    Scan results of this process, (path, part, settings) -> (file identity, result);
+    the least recently used are dropped once they add up to more than max_bytes
+    """
+    def __init__(self, max_bytes=MEMO_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.results = OrderedDict()
+
+    def __repr__(self):
+        return f'ScanMemo({len(self.results)} results, {self.nbytes} bytes)'
+
+    def get(self, key, identity):
+        """
+        (True, result) if key was kept for a file with identity, else (False, None)
+        """
+        kept = self.results.get(key)
+        if kept is None or identity is None or kept[0] != identity:
+            return False, None
+        self.results.move_to_end(key)
+        return True, kept[1]
+
+    def put(self, key, identity, value):
+        """
+        keep a result, dropping the oldest ones past max_bytes
+        """
+        if key in self.results:
+            self.nbytes -= result_bytes(self.results.pop(key)[1])
+        self.results[key] = (identity, value)
+        self.nbytes += result_bytes(value)
+        while self.nbytes > self.max_bytes and len(self.results) > 0:
+            _, (_, dropped) = self.results.popitem(last=False)
+            self.nbytes -= result_bytes(dropped)
+
+    def clear(self):
+        """
+        drop every result
+        """
+        self.results.clear()
+        self.nbytes = 0
+
+SCANNED = ScanMemo()
+
+def open_scan_cache(hash_cache):
+    """
+    the scan results table (SCAN_TABLE) of a HashCache's database; None without one.
+    It has its own eviction, so decode results never push content hashes out.
+    """
+    if hash_cache is None:
+        return None
+    return HashCache(hash_cache.path, SCAN_MAX_ENTRIES, table=SCAN_TABLE)
+
+def to_text(part, value):
+    """
+    a scan result as text for the scan cache
+    """
+    if value is None:
+        return 'null'
+    if part == 'energy':
+        return base64.b64encode(value.tobytes()).decode('ascii')
+    return json.dumps(value)
+
+def from_text(part, text):
+    """
+    a scan result from its scan cache text
+    """
+    if text == 'null':
+        return None
+    if part == 'energy':
+        return np.frombuffer(base64.b64decode(text), dtype=np.float32)
+    return json.loads(text)
+
+def scan_files(paths, max_workers=None, hash_cache=None, block_frames=65536,
+               measure=None, fingerprint=None):
+    """
+    {path: scan_audio(path) result} across a process pool; max_workers=1 decodes in this
+    process. Only files without every part asked for (in this process, or in the
+    SCAN_TABLE of hash_cache's database while their size and mtime are unchanged) are
+    decoded. Files that could not be opened, or were not decoded all the way through,
+    are only kept for this process.
+    """
+    paths = list(dict.fromkeys(paths))
+    parts = part_settings(measure, fingerprint)
+    identities = {path: file_identity(path) for path in paths}
+    scanned = {path: {'integrity': None, 'quality': None, 'energy': None} for path in paths}
+    found = {path: set() for path in paths}
+    for path in paths:
+        for part, settings in parts.items():
+            kept, value = SCANNED.get((path, part, settings), identities[path])
+            if kept:
+                scanned[path][part] = value
+                found[path].add(part)
+    scan_cache = open_scan_cache(hash_cache)
+    try:
+        return scan_missing(paths, scanned, found, identities, parts, scan_cache, max_workers,
+                            partial(scan_audio, block_frames=block_frames, measure=measure,
+                                    fingerprint=fingerprint))
+    finally:
+        if scan_cache is not None:
+            scan_cache.close()
+
+def scan_missing(paths, scanned, found, identities, parts, scan_cache, max_workers, scan):
+    """
+    scan_files() of the paths that were not kept in this process: reads scan_cache,
+    decodes the rest and keeps their results
+    """
+    if scan_cache is not None:
+        for part, settings in parts.items():
+            missing = [path for path in paths if part not in found[path]]
+            for path, text in scan_cache.get_many(missing, cache_kind(part, settings)).items():
+                scanned[path][part] = from_text(part, text)
+                found[path].add(part)
+
+    missing = [path for path in paths if len(found[path]) < len(parts)]
+    if max_workers == 1 or len(missing) <= 1:
+        results = [scan(path) for path in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(scan, missing, chunksize=4))
+
+    to_cache = {part: {} for part in parts}
+    for path, result in zip(missing, results):
+        scanned[path] = result
+        for part, settings in parts.items():
+            SCANNED.put((path, part, settings), identities[path], result[part])
+        integrity = result['integrity']
+        if integrity is not None and integrity['integrity_error'] in ('unreadable', 'decode_error'):
+            continue
+        for part in parts:
+            to_cache[part][path] = to_text(part, result[part])
+    if scan_cache is not None:
+        for part, settings in parts.items():
+            scan_cache.put_many(to_cache[part], cache_kind(part, settings))
+    return scanned
@@ -3,7 +3,6 @@ clean_dataset.py
 methods for accessing and updating the clean dataset
 """
 import os
-import shutil
 import json
 from collections import defaultdict
 from pathlib import Path
@@ -11,6 +10,10 @@ from tqdm import tqdm
 from qc_scripts.utility.get_latest_data import get_root_fp
 from qc_scripts.utility.read import read_dictionary_file
 from qc_scripts.logger import edit_static_json
+from qc_scripts.clean_store import CleanStore, open_clean_store, is_clean_store
+from qc_scripts.snapshots import open_snapshots, content_hash
+from qc_scripts.query import open_index
+from qc_scripts.probe import id_date_batches, as_entries
 
 def deduplicate_by_src(dict_list):
     """
@@ -25,25 +28,127 @@ def deduplicate_by_src(dict_list):
             unique_dicts.append(d)
     return unique_dicts
 
+def read_clean_dataset(clean_dataset):
+    """
+    the clean dataset as a dictionary, from clean_dataset.json or a clean store;
+    {} if there is none yet
+    """
+    if clean_dataset in ('', None):
+        return {}
+    if is_clean_store(clean_dataset):
+        with CleanStore(clean_dataset) as clean_store:
+            return clean_store.to_dict()
+    return read_dictionary_file(clean_dataset)
+
+def staged_srcs(clean_dataset, srcs):
+    """
+    the srcs that are in the clean dataset as staged entries (copied or linked to their
+    dst and left in place); read from the clean store or the index of clean_dataset.json
+    """
+    if clean_dataset in ('', None) or len(srcs) == 0:
+        return set()
+    if isinstance(clean_dataset, str):
+        if not os.path.isfile(clean_dataset):
+            return set()
+        with open_index(clean_dataset) as index:
+            found = index.get_many(srcs)
+        return {src for src, entry in found.items() if entry.get('staged')}
+    srcs = set(srcs)
+    return {entry['src'] for data in clean_dataset.values() for entry in data or []
+            if entry.get('src') in srcs and entry.get('staged')}
+
+def has_staged(clean_dataset):
+    """
+    True if the clean dataset has any staged entries; a clean store or the index of
+    clean_dataset.json is counted once, without reading the entries
+    """
+    if clean_dataset in ('', None):
+        return False
+    if isinstance(clean_dataset, str):
+        if not os.path.isfile(clean_dataset):
+            return False
+        with open_index(clean_dataset) as index:
+            return index.count_where('data LIKE ?', ('%"staged": true%',)) > 0
+    return any(entry.get('staged') for data in clean_dataset.values() for entry in data or [])
+
+def skip_staged(input_data, **kwargs):
+    """
+    Takes out the files a staged run already put in the clean dataset: stage (and
+    checksum_copy) leave the originals where they were, so later walks find them again.
+    They are matched on src, so hardlinks, reflinks and copies are all skipped the same way.
+    Files are looked up batch_size at a time, so a streamed walk (.ndjson) is read one
+    line at a time; the outputs are dictionaries like those of the other flag nodes.
+    The flag pipeline only adds this node if has_staged(clean_dataset).
+    """
+    clean_dataset = kwargs.get('clean_dataset', '')
+    ext = kwargs.get('ext', 'staged')
+    batch_size = kwargs.get('batch_size', 10000)
+    passed, skipped = defaultdict(list), defaultdict(list)
+    for batch in id_date_batches(input_data, batch_size):
+        staged = staged_srcs(clean_dataset, [entry['src'] for _, data in batch
+                                             for entry in as_entries(data)])
+        for id_date, data in batch:
+            for entry in as_entries(data):
+                (skipped if entry['src'] in staged else passed)[id_date].append(entry)
+    return [{'final': passed, 'ext': 'passed'},
+            {'final': skipped, 'ext': ext}]
+
+def update_clean_store(input_data, clean_store, clean_dataset, export=None, snapshots=None):
+    """
+    Adds the new data to a clean store in one transaction; on first use the
+    current clean_dataset.json is imported. export writes the JSON layout to a path.
+    """
+    if clean_store.count() == 0 and clean_dataset not in ('', None) \
+            and not is_clean_store(clean_dataset):
+        print(f'Importing {clean_dataset} into {clean_store.path}.')
+        clean_store.add(read_dictionary_file(clean_dataset))
+    if snapshots is not None:
+        if snapshots.head() is None:
+            snapshots.start(clean_store.to_dict())
+        before = {id_date: content_hash(clean_store.entries(id_date)) for id_date in input_data}
+    n_entries = clean_store.add(input_data)
+    if snapshots is not None:
+        snapshots.commit_changed(before, {id_date: clean_store.entries(id_date)
+                                          for id_date in input_data})
+    print(f'Added {n_entries} entries to {clean_store.path}.')
+    edit_static_json('static.json', clean_store.path, "clean_dataset")
+    if export is not None:
+        print(f'See {clean_store.export_json(export)} for the exported clean dataset.')
+
 def update_clean_dataset(input_data, **kwargs):
     """
-    Takes in final result from the pipeline and adds it to the clean dataset
+    Takes in final result from the pipeline and adds it to the clean dataset;
+    checksums (k=src) taken while the files were copied are added to their entries,
+    along with 'staged' for files that were copied or linked and left in place.
+    With a clean_store (SQLite), only the new entries are written.
+    Each update is kept as a version in snapshots (only the id_dates that were added or
+    changed are stored), instead of a full copy of the previous clean dataset.
     """
     ## kwargs
     clean_dataset = kwargs.get('clean_dataset')
+    checksums = kwargs.get('checksums', {})
+    clean_store = open_clean_store(kwargs.get('clean_store'))
 
     ## Take in a filepath or data
     if isinstance(input_data, str):
         input_data = read_dictionary_file(input_data)
 
+    if len(checksums) > 0:
+        for data in input_data.values():
+            for entry in data or []:
+                entry.update(checksums.get(entry.get('src'), {}))
+
+    if clean_store is not None:
+        try:
+            update_clean_store(input_data, clean_store, clean_dataset, kwargs.get('export'),
+                               open_snapshots(kwargs.get('snapshots'), clean_store.path))
+        finally:
+            if not isinstance(kwargs.get('clean_store'), CleanStore):
+                clean_store.close()
+        return
+
     ## If a clean dataset currently exists
     if clean_dataset != "":
-        ## make a copy of the current clean_dataset
-        dir_name, filename = os.path.split(clean_dataset)
-        name, ext = os.path.splitext(filename)
-        copy_name = os.path.join(dir_name, f'{name}_previous{ext}')
-        shutil.copy2(clean_dataset, copy_name)
-
         ## read clean_dataset
         updated_clean = read_dictionary_file(clean_dataset)
 
@@ -54,6 +159,15 @@ def update_clean_dataset(input_data, **kwargs):
         clean_dataset = f'{clean_root}/clean_dataset.json'
         Path(clean_dataset).parent.mkdir(parents=True, exist_ok=True)
 
+    ## the history starts with the clean dataset as it was; only changes are kept after
+    snapshots = open_snapshots(kwargs.get('snapshots'), clean_dataset)
+    if snapshots is not None:
+        snapshots.start(updated_clean)
+        ## an id_date that is not there yet has no hash, so it is committed even if its
+        ## entries are None
+        before = {id_date: content_hash(updated_clean[id_date]) for id_date in input_data
+                  if id_date in updated_clean}
+
     ## add new data to the clean dataset
     for id_date, data in tqdm(input_data.items()):
         if id_date not in updated_clean:
@@ -69,4 +183,6 @@ def update_clean_dataset(input_data, **kwargs):
     with open(clean_dataset, 'w', encoding='utf-8') as f:
         json.dump(updated_clean, f, indent=4)
     print(f'See {clean_dataset} for updated clean dataset.')
+    if snapshots is not None:
+        snapshots.commit_changed(before, {id_date: updated_clean[id_date] for id_date in input_data})
     edit_static_json('static.json', clean_dataset, "clean_dataset")
@@ -0,0 +1,288 @@
+"""
+clean_store.py
+SQLite store for the clean dataset: one row per file with a unique index on
+(id_date, src), so adding a batch only touches the rows of that batch
+"""
+import os
+import json
+import sqlite3
+import threading
+import functools
+from qc_scripts.utility.get_latest_data import get_root_fp
+
+STORE_EXTS = ('.sqlite3', '.sqlite', '.db')
+## entry fields with their own indexed column
+INDEXED_FIELDS = ('pid', 'date', 'tester_id', 'location')
+## stay under SQLite's default limit on query parameters
+LOOKUP_CHUNK = 500
+## PRAGMA user_version of the entries table layout; older stores are migrated on open
+SCHEMA_VERSION = 2
+ENTRIES_TABLE = '''CREATE TABLE IF NOT EXISTS entries (
+    src TEXT NOT NULL, id_date TEXT, pid TEXT, date TEXT, tester_id TEXT, location TEXT,
+    dst TEXT, size INTEGER, data TEXT, UNIQUE (id_date, src))'''
+
+def locked(method):
+    """
+    run a CleanStore method while holding its lock
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def is_clean_store(path):
+    """
+    True if path is (by its extension) a clean dataset store rather than a JSON file
+    """
+    return isinstance(path, str) and os.path.splitext(path)[1].lower() in STORE_EXTS
+
+class CleanStore:
+    """
+    Clean dataset entries keyed on (id_date, src), like clean_dataset.json: the same src
+    can be under more than one id_date, and adding an entry that is already stored under
+    its id_date keeps the stored one. The pid, date, tester_id, location and dst of each
+    entry are in indexed columns and the whole entry is kept as JSON.
+    size is the file size at dst (or src), read the first time it is needed (fill_sizes()),
+    so duplicate checks only read the entries with the sizes they look for.
+    Rows keep the order they were first added in, so export_json() writes the
+    same layout as clean_dataset.json ({id_date: [entry, ...]}).
+    """
+    def __init__(self, path):
+        parent = os.path.dirname(path)
+        if parent != '':
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.migrate()
+        for column in ('src', 'size') + INDEXED_FIELDS:
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS entries_{column} ON entries ({column})')
+        self.connection.commit()
+
+    def __repr__(self):
+        return f'CleanStore({self.path!r})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.count()
+
+    @locked
+    def close(self):
+        """
+        close the database connection
+        """
+        self.connection.close()
+
+    def migrate(self):
+        """
+        create the entries table, or rebuild one written with an older layout
+        (SCHEMA_VERSION), keeping its rows in order
+        """
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        exists = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'").fetchone()
+        with self.connection:
+            if exists is not None and version < SCHEMA_VERSION:
+                self.connection.execute('ALTER TABLE entries RENAME TO entries_old')
+                self.connection.execute(ENTRIES_TABLE)
+                columns = [row[1] for row in self.connection.execute('PRAGMA table_info(entries)')]
+                old_columns = {row[1] for row in self.connection.execute('PRAGMA table_info(entries_old)')}
+                shared = ', '.join(column for column in columns if column in old_columns)
+                self.connection.execute(f'INSERT OR IGNORE INTO entries ({shared}) '
+                                        f'SELECT {shared} FROM entries_old ORDER BY rowid')
+                self.connection.execute('DROP TABLE entries_old')
+            self.connection.execute(ENTRIES_TABLE)
+            self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    @locked
+    def count(self):
+        """
+        number of entries
+        """
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    @locked
+    def add(self, input_data):
+        """
+        add {id_date: [entry, ...]} in one transaction; an entry whose src is already
+        stored under the same id_date is skipped and the stored entry kept, as
+        update_clean_dataset() does for clean_dataset.json. Returns the number of
+        entries added.
+        """
+        rows = []
+        for id_date, data in input_data.items():
+            for entry in data or []:
+                rows.append((entry['src'], id_date,
+                             *(None if entry.get(field) is None else str(entry[field])
+                               for field in INDEXED_FIELDS),
+                             entry.get('dst'), json.dumps(entry)))
+        changes = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(
+                '''INSERT INTO entries (src, id_date, pid, date, tester_id, location, dst, data)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id_date, src) DO NOTHING''',
+                rows)
+        return self.connection.total_changes - changes
+
+    @locked
+    def get_many(self, srcs):
+        """
+        bulk lookup; returns {src: entry} for the srcs that are stored
+        (the first entry added, if a src is under more than one id_date)
+        """
+        found = {}
+        srcs = list(srcs)
+        for start in range(0, len(srcs), LOOKUP_CHUNK):
+            chunk = srcs[start:start + LOOKUP_CHUNK]
+            rows = self.connection.execute(
+                f"SELECT src, data FROM entries WHERE src IN ({','.join('?' * len(chunk))}) "
+                'ORDER BY rowid DESC', chunk)
+            found.update((src, json.loads(data)) for src, data in rows)
+        return found
+
+    @locked
+    def fill_sizes(self):
+        """
+        stat the files of the entries without a size yet; -1 for files that are missing
+        """
+        rows = self.connection.execute(
+            'SELECT rowid, dst, src FROM entries WHERE size IS NULL').fetchall()
+        sizes = []
+        for rowid, dst, src in rows:
+            try:
+                sizes.append((os.path.getsize(dst or src), rowid))
+            except OSError:
+                sizes.append((-1, rowid))
+        with self.connection:
+            self.connection.executemany('UPDATE entries SET size = ? WHERE rowid = ?', sizes)
+
+    @locked
+    def copy_sizes(self, path):
+        """
+        take the sizes of the entries another store at path already has
+        (the same id_date and src), so they are not read again
+        """
+        self.connection.execute('ATTACH DATABASE ? AS other', (path,))
+        try:
+            with self.connection:
+                self.connection.execute(
+                    '''UPDATE entries SET size = (SELECT old.size FROM other.entries AS old
+                       WHERE old.id_date = entries.id_date AND old.src = entries.src)
+                       WHERE size IS NULL''')
+        except sqlite3.OperationalError:
+            ## a store without sizes
+            pass
+        finally:
+            self.connection.execute('DETACH DATABASE other')
+
+    @locked
+    def entries_of_size(self, sizes):
+        """
+        [(id_date, entry), ...] of the entries whose file has one of sizes
+        """
+        self.fill_sizes()
+        found = []
+        sizes = list(sizes)
+        for start in range(0, len(sizes), LOOKUP_CHUNK):
+            chunk = sizes[start:start + LOOKUP_CHUNK]
+            rows = self.connection.execute(
+                f"SELECT id_date, data FROM entries WHERE size IN ({','.join('?' * len(chunk))}) "
+                'ORDER BY rowid', chunk)
+            found.extend((id_date, json.loads(data)) for id_date, data in rows)
+        return found
+
+    @locked
+    def id_dates(self):
+        """
+        id_dates in the order they were first added
+        """
+        rows = self.connection.execute(
+            'SELECT id_date, MIN(rowid) AS first FROM entries GROUP BY id_date ORDER BY first')
+        return [id_date for id_date, _ in rows]
+
+    @locked
+    def entries(self, id_date):
+        """
+        entries of an id_date in the order they were added
+        """
+        rows = self.connection.execute(
+            'SELECT data FROM entries WHERE id_date = ? ORDER BY rowid', (id_date,))
+        return [json.loads(data) for data, in rows]
+
+    @locked
+    def select(self, where='1', params=(), after=0, limit=None):
+        """
+        [(rowid, entry), ...] of the rows matching a SQL where clause, in the order
+        they were added, starting after the rowid after (keyset pagination)
+        """
+        sql = f'SELECT rowid, data FROM entries WHERE rowid > ? AND ({where}) ORDER BY rowid'
+        params = [after] + list(params)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [(rowid, json.loads(data)) for rowid, data in self.connection.execute(sql, params)]
+
+    @locked
+    def count_where(self, where='1', params=()):
+        """
+        number of rows matching a SQL where clause
+        """
+        return self.connection.execute(
+            f'SELECT COUNT(*) FROM entries WHERE {where}', list(params)).fetchone()[0]
+
+    def items(self):
+        """
+        yields (id_date, [entry, ...]) one id_date at a time
+        """
+        for id_date in self.id_dates():
+            yield id_date, self.entries(id_date)
+
+    def to_dict(self):
+        """
+        the whole store in the clean_dataset.json layout
+        """
+        return dict(self.items())
+
+    def export_json(self, path):
+        """
+        writes the clean_dataset.json layout one id_date at a time (same format as
+        json.dump(..., indent=4)) to a temporary file that is renamed into place
+        """
+        parent = os.path.dirname(path)
+        if parent != '':
+            os.makedirs(parent, exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write('{')
+            for idx, (id_date, data) in enumerate(self.items()):
+                f.write(',\n    ' if idx > 0 else '\n    ')
+                f.write(f'{json.dumps(id_date)}: ')
+                f.write(json.dumps(data, indent=4).replace('\n', '\n    '))
+            f.write('\n}' if self.count() > 0 else '}')
+        os.replace(f'{path}.tmp', path)
+        return path
+
+def open_clean_store(clean_store=None):
+    """
+    get a CleanStore from a CleanStore or a path to the database.
+    If clean_store is None, the 'clean_store' path in config.json is used if it is set;
+    returns None if there is no store (or clean_store is False).
+    """
+    if clean_store is False:
+        return None
+    if isinstance(clean_store, CleanStore):
+        return clean_store
+    if clean_store is None:
+        try:
+            clean_store = get_root_fp('clean_store')
+        except (KeyError, FileNotFoundError):
+            return None
+    if clean_store in ('', None):
+        return None
+    return CleanStore(clean_store)
@@ -5,119 +5,116 @@ Methods for comparing file data to records
 from datetime import datetime
 from collections import defaultdict
 from tqdm import tqdm
-from qc_scripts.utility.read import read_dictionary_file
+from qc_scripts.record_index import get_record_index
+from qc_scripts.utility.read import dictionary_items
 
-def flag_id_date(input_data, **kwargs):
+class IdDateCheck:
     """
     Compare id_dates in filenames to the records we have from records
-
     """
-    ## Get kwargs
-    records = kwargs.get('records')
-    record_end_date = kwargs.get('record_end_date', datetime.now().date())
-    ext = kwargs.get('ext', '')
-    rc_tester_id_fieldname = kwargs.get('rc_tester_id_fieldname')
-    rc_date_fieldname = kwargs.get('rc_date_fieldname')
-    ignore_flagged = kwargs.get('ignore_flagged', [])
-
-
-    ## Allows for input to be either a filepath or a dictionary of data
-    if isinstance(input_data, str):
-        input_data = read_dictionary_file(input_data)
-
-    if isinstance(records, str):
-        records = read_dictionary_file(records)
-
-    record_id_dates = list(records.keys())
-    flagged_no_record = {}
-    passed = {}
-
-    # checks our dvrs to see if they have a record
-    for id_date, data in tqdm(input_data.items()):
+    func_name = 'flag_id_date'
+
+    def __init__(self, records, **kwargs):
+        self.records = records
+        self.record_end_date = kwargs.get('record_end_date', datetime.now().date())
+        self.ext = kwargs.get('ext', '')
+        self.rc_tester_id_fieldname = kwargs.get('rc_tester_id_fieldname')
+        self.rc_date_fieldname = kwargs.get('rc_date_fieldname')
+        self.ignore_flagged = kwargs.get('ignore_flagged', [])
+        self.nearest_window_days = kwargs.get('nearest_window_days', None)
+
+    def flag_exts(self):
+        """
+        exts of the flagged outputs
+        """
+        return [f"flagged_no_records_{self.ext}"]
+
+    def __call__(self, id_date, data):
+        """
+        returns the entries that passed and {flag_ext: flagged entries};
+        id_dates after the record_end_date are dropped
+        """
         ## get file date
         date_of_file = datetime.strptime(id_date.split('_')[-1], "%Y%m%d").date()
         ## add in validate fid
-        if id_date not in record_id_dates:
-            if id_date in ignore_flagged:
-                passed[id_date] = data
-                continue
-            nearest = []
-            for idd in (idd for idd in record_id_dates if data[0]['pid'] in idd):
-                for i in data:
-                    try:
-                        idd_date = datetime.strptime(idd.split('_')[-1], "%Y%m%d").date()
-                        difference = abs((idd_date - date_of_file).days)
-                    except ValueError:
-                        difference = 'Error'
-                    ra = records[idd][rc_tester_id_fieldname]
-                    date = records[idd][rc_date_fieldname].replace('-', '')
-                    nearest.append({'id_date': idd, 'date': date, 'difference': difference,
-                                    'tester_id_completing': ra})
-                    i['nearest'] = nearest
-
-            flagged_no_record[id_date] = data
-        else:
-            if date_of_file <= record_end_date:
-                passed[id_date] = data
-
-    return [{'final': passed, "ext": "passed"},
-            {'final': flagged_no_record, "ext": f"flagged_no_records_{ext}"}]
-
-def flag_tester_id(input_data, **kwargs):
+        if id_date in self.records:
+            if date_of_file <= self.record_end_date:
+                return data, {}
+            return [], {}
+        if id_date in self.ignore_flagged:
+            return data, {}
+        nearest = []
+        for idd, difference in self.records.nearest(data[0]['pid'], date_of_file,
+                                                    self.nearest_window_days):
+            ra = self.records[idd][self.rc_tester_id_fieldname]
+            date = self.records[idd][self.rc_date_fieldname].replace('-', '')
+            nearest.append({'id_date': idd, 'date': date, 'difference': difference,
+                            'tester_id_completing': ra})
+        if len(nearest) > 0:
+            for i in data:
+                i['nearest'] = nearest
+        return [], {f"flagged_no_records_{self.ext}": data}
+
+class TesterIdCheck:
     """
     Checks that the tester_id in the filename matches the one recorded in records
     """
-    ## Get kwargs
-    records = kwargs.get('records')
-    ext = kwargs.get('ext', '')
-    rc_tester_id_fieldname = kwargs.get('rc_tester_id_fieldname')
-    ignore_flagged = kwargs.get('ignore_flagged', [])
-
-    if isinstance(input_data, str):
-        input_data = read_dictionary_file(input_data)
-
-    if isinstance(records, str):
-        records = read_dictionary_file(records)
-
-    flagged_tester_id_mismatch = defaultdict(list)
-    id_date_not_found = defaultdict(list)
-    passed = defaultdict(list)
-    for id_date, data in tqdm(input_data.items()):
-        if id_date in ignore_flagged:
-            passed[id_date] = data
-            continue
+    func_name = 'flag_tester_id'
+
+    def __init__(self, records, **kwargs):
+        self.records = records
+        self.ext = kwargs.get('ext', '')
+        self.rc_tester_id_fieldname = kwargs.get('rc_tester_id_fieldname')
+        self.ignore_flagged = kwargs.get('ignore_flagged', [])
+
+    def flag_exts(self):
+        """
+        exts of the flagged outputs
+        """
+        return [f"flagged_tester_id_mismatch_{self.ext}", f'flagged_tester_id_no_records_{self.ext}']
+
+    def __call__(self, id_date, data):
+        """
+        returns the entries that passed and {flag_ext: flagged entries}
+        """
+        if id_date in self.ignore_flagged:
+            return data, {}
         try:
-            rc_tester_id = records[id_date][rc_tester_id_fieldname]
+            rc_tester_id = self.records[id_date][self.rc_tester_id_fieldname]
         except KeyError:
-            print(f'{id_date} not found in {rc_tester_id_fieldname}')
-            id_date_not_found[id_date] = data
-        else:
-            for item in data:
-                if item['tester_id'] != rc_tester_id:
-                    item['rc_tester_id'] = rc_tester_id
-                    flagged_tester_id_mismatch[id_date].append(item)
-                else:
-                    passed[id_date].append(item)
-
-    return [{'final': passed, "ext": "passed"},
-            {'final': flagged_tester_id_mismatch, "ext": f"flagged_tester_id_mismatch_{ext}"},
-            {'final': id_date_not_found, 'ext': f'flagged_tester_id_no_records_{ext}'}]
+            print(f'{id_date} not found in {self.rc_tester_id_fieldname}')
+            return [], {f'flagged_tester_id_no_records_{self.ext}': data}
+        passed, mismatch = [], []
+        for item in data:
+            if item['tester_id'] != rc_tester_id:
+                item['rc_tester_id'] = rc_tester_id
+                mismatch.append(item)
+            else:
+                passed.append(item)
+        return passed, {f"flagged_tester_id_mismatch_{self.ext}": mismatch}
 
-def check_location(input_data, **kwargs):
+class LocationCheck:
     """
     Checks remote vs in-person file matches record keying
-    Returns Boolean: True (match) or False (no match)
-            walkdata updated with variables
+    walkdata updated with variables
     """
-    records = kwargs.get('records')
-    if isinstance(records, str):
-        records = read_dictionary_file(records)
-
-    match = defaultdict(list)
-    location_mismatch = defaultdict(list)
-
-    for id_date, data in tqdm(input_data.items()):
-        location = records[id_date]['data_loc']
+    func_name = 'check_location'
+
+    def __init__(self, records, **_):
+        self.records = records
+
+    def flag_exts(self):
+        """
+        exts of the flagged outputs
+        """
+        return ["location_mismatch"]
+
+    def __call__(self, id_date, data):
+        """
+        returns the entries that passed and {flag_ext: flagged entries}
+        """
+        location = self.records[id_date]['data_loc']
+        match, location_mismatch = [], []
         for entry in data:
             entry['location'] = entry['location'].lower()
             if location in ('0', 'remote'):
@@ -128,9 +125,64 @@ def check_location(input_data, **kwargs):
                 entry['record_location'] = 'undefined'
             if (entry['record_location'] != entry['location'] or
                 entry['record_location'] == 'undefined'):
-                location_mismatch[id_date].append(entry)
+                location_mismatch.append(entry)
             else:
-                match[id_date].append(entry)
+                match.append(entry)
+        return match, {"location_mismatch": location_mismatch}
 
-    return [{'final': match, "ext": "passed"},
-            {'final': location_mismatch, "ext": "location_mismatch"}]
+def check_records(input_data, **kwargs):
+    """
+    Runs a list of record checks (IdDateCheck, TesterIdCheck, LocationCheck, ...) in a
+    single pass over the data against one shared RecordIndex. Entries flagged by a check
+    are not passed to the checks after it.
+    Returns the entries that passed every check and each check's flagged outputs;
+    each flagged output is tagged with the check's func_name for write_output_func.
+    A .ndjson input is read one line at a time, but the outputs are dictionaries of
+    every id_date, so memory grows with the input (only the walk itself is bounded).
+    """
+    records = get_record_index(kwargs.get('records'))
+    check_classes = kwargs.get('checks', [IdDateCheck, TesterIdCheck, LocationCheck])
+    check_kwargs = {k: v for k, v in kwargs.items() if k not in ('records', 'checks')}
+    checks = [check_class(records, **check_kwargs) for check_class in check_classes]
+
+    passed = defaultdict(list)
+    flagged = [{ext: defaultdict(list) for ext in check.flag_exts()} for check in checks]
+
+    ## Allows for input to be a filepath (.ndjson files are streamed) or a dictionary of data
+    for id_date, data in tqdm(dictionary_items(input_data)):
+        for check, check_flagged in zip(checks, flagged):
+            data, flags = check(id_date, data)
+            for flag_ext, entries in flags.items():
+                if len(entries) > 0:
+                    check_flagged[flag_ext][id_date].extend(entries)
+            if len(data) == 0:
+                break
+        else:
+            passed[id_date] = data
+
+    results = [{'final': passed, 'ext': 'passed'}]
+    for check, check_flagged in zip(checks, flagged):
+        results.extend({'final': final, 'ext': flag_ext, 'func_name': check.func_name}
+                       for flag_ext, final in check_flagged.items())
+    return results
+
+def flag_id_date(input_data, **kwargs):
+    """
+    Compare id_dates in filenames to the records we have from records
+
+    """
+    return check_records(input_data, **dict(kwargs, checks=[IdDateCheck]))
+
+def flag_tester_id(input_data, **kwargs):
+    """
+    Checks that the tester_id in the filename matches the one recorded in records
+    """
+    return check_records(input_data, **dict(kwargs, checks=[TesterIdCheck]))
+
+def check_location(input_data, **kwargs):
+    """
+    Checks remote vs in-person file matches record keying
+    Returns Boolean: True (match) or False (no match)
+            walkdata updated with variables
+    """
+    return check_records(input_data, **dict(kwargs, checks=[LocationCheck]))
@@ -5,6 +5,9 @@ writes destinations for passed files
 import os
 import re
 from tqdm import tqdm
+from qc_scripts.utility.pattern import PatternSet, destination_pattern_data
+
+DST_PATTERN_SET = PatternSet(destination_pattern_data(), flags=re.IGNORECASE)
 
 def standardize_filename(match_groups, ext):
     """
@@ -18,20 +21,18 @@ def standardize_filename(match_groups, ext):
     location = match_groups[5].lower()
     return f'{id_type}_{pid}_{date}_{tech_id}_{location}{ext}'
 
-def dst_filename(filepath, filename_prefix=None):
+def dst_filename(filepath, filename_prefix=None, pattern_set=DST_PATTERN_SET):
     """
     Makes sure that the filename is in the correct format 
     """
-    pattern = re.compile(r'([A-Za-z]{2})(\d{1,2})_(\d{4,5})_(\d{8})_(\d{3,4})_(remote|in-person)',
-                         flags=re.IGNORECASE)
     dir_path, filename = os.path.split(filepath)
     name, ext = os.path.splitext(filename)
 
-    match = pattern.search(name)
-    if not match:
+    index, value = pattern_set.search(name)
+    if index is None:
         raise ValueError("Filename does not contain the expected pattern")
 
-    groups = match.groups()
+    groups = list(value.values())
     corrected_name = standardize_filename(groups, ext)
     if filename_prefix is not None:
         corrected_name = f'{filename_prefix}_{corrected_name}'
@@ -4,10 +4,15 @@ Methods for dealing with duplicate data
 """
 import os
 import filecmp
-import hashlib
 from collections import defaultdict
 from tqdm import tqdm
 import soundfile as sf
+from qc_scripts.utility.hash_cache import open_hash_cache, HashCache
+from qc_scripts.utility.hashing import (file_hash, partial_file_hash, hash_files,
+                                         DEFAULT_ALGORITHM)
+from qc_scripts.query import open_index
+from qc_scripts.fingerprint import near_duplicate_groups
+from qc_scripts.probe import entry_durations
 
 def flag_file_count(input_data, **kwargs):
     """
@@ -24,15 +29,6 @@ def flag_file_count(input_data, **kwargs):
     return [{'final': passed, 'ext': 'passed'},
             {'final': extra_files, 'ext': 'extra_files'}]
 
-def file_hash(path):
-    """
-    Generate MD5 hash for a file
-    """
-    hasher = hashlib.md5()
-    with open(path, 'rb') as f:
-        hasher.update(f.read())
-    return hasher.hexdigest()
-
 def get_duration(filepath):
     """
     Gets the duration of an audio file in seconds
@@ -71,49 +67,215 @@ def check_file_extension(file1, file2):
     ext2 = os.path.splitext(file2)[1].lower()
     return ext1 == ext2
 
+def group_by(indices, key_func):
+    """
+    split indices into lists sharing the same key_func(index); drops lists of one
+    """
+    buckets = defaultdict(list)
+    for idx in indices:
+        buckets[key_func(idx)].append(idx)
+    return [bucket for bucket in buckets.values() if len(bucket) > 1]
+
+def group_by_filecmp(indices, paths, shallow=True):
+    """
+    split indices into groups of equal files by comparing pairs with filecmp
+    """
+    groups = []
+    for idx in indices:
+        for group in groups:
+            if filecmp.cmp(paths[group[0]], paths[idx], shallow):
+                group.append(idx)
+                break
+        else:
+            groups.append([idx])
+    return [group for group in groups if len(group) > 1]
+
+def duplicate_groups(paths, compare_hash=True, compare_duration=True, **kwargs):
+    """
+    Groups duplicate files; returns lists of indices into paths, each in ascending order
+    and ordered by their first index. Files are only compared within the same key (if keys
+    are given) and size, hashed at most once (first and last blocks, then the full file if
+    those collide) and their durations are only read within groups of equal content.
+    Each round of hashing runs across max_workers threads.
+    hashes and durations can be dictionaries shared across calls (k=path);
+    sizes can be given if the files were already stat'ed.
+    use_processes hashes on a process pool instead of threads, and use_mmap reads
+    full hashes through mmap (see hashing.py).
+    """
+    hashes = kwargs.get('hashes', {})
+    partial_hashes = kwargs.get('partial_hashes', {})
+    durations = kwargs.get('durations', {})
+    block_size = kwargs.get('block_size', 65536)
+    hash_kw = {'algorithm': kwargs.get('algorithm', DEFAULT_ALGORITHM),
+               'max_workers': kwargs.get('max_workers', None),
+               'use_processes': kwargs.get('use_processes', False)}
+    keys = kwargs.get('keys')
+    sizes = kwargs.get('sizes')
+    if sizes is None:
+        sizes = [os.path.getsize(path) for path in paths]
+
+    def get_size_key(idx):
+        return sizes[idx] if keys is None else (keys[idx], sizes[idx])
+
+    def get_partial_hash(idx):
+        ## files of up to two blocks are read whole, so their partial hash is the full hash
+        if sizes[idx] <= 2 * block_size and paths[idx] in hashes:
+            return hashes[paths[idx]]
+        return partial_hashes.get(paths[idx])
+
+    def get_hash(idx):
+        return hashes.get(paths[idx])
+
+    def get_cached_duration(idx):
+        path = paths[idx]
+        if path not in durations:
+            durations[path] = get_duration(path)
+        return durations[path]
+
+    def split(buckets, key_func):
+        ## files that could not be hashed are not duplicates of anything
+        return [group for bucket in buckets
+                for group in group_by([idx for idx in bucket if key_func(idx) is not None], key_func)]
+
+    groups = group_by(range(len(paths)), get_size_key)
+    if compare_hash:
+        hashed = [group for group in groups if all(paths[idx] in hashes for idx in group)]
+        unhashed = [group for group in groups if any(paths[idx] not in hashes for idx in group)]
+        missing = [paths[idx] for group in unhashed for idx in group if get_partial_hash(idx) is None]
+        for path, (partial, is_full) in hash_files(missing, partial_file_hash, block_size=block_size,
+                                                   **hash_kw).items():
+            (hashes if is_full else partial_hashes)[path] = partial
+        groups = hashed + split(unhashed, get_partial_hash)
+        missing = [paths[idx] for group in groups for idx in group if get_hash(idx) is None]
+        hashes.update(hash_files(missing, file_hash, use_mmap=kwargs.get('use_mmap', False),
+                                 **hash_kw))
+        groups = split(groups, get_hash)
+    else:
+        groups = [group for bucket in groups for group in group_by_filecmp(bucket, paths)]
+    if compare_duration:
+        groups = [group for bucket in groups for group in group_by(bucket, get_cached_duration)]
+    return sorted(sorted(group) for group in groups)
+
+def hash_options(kwargs):
+    """
+    the use_processes and use_mmap hashing options of a node's kwargs
+    """
+    return {k: v for k, v in kwargs.items() if k in ('use_processes', 'use_mmap')}
+
+def load_cached_hashes(hash_cache, paths, block_size=65536, algorithm=DEFAULT_ALGORITHM):
+    """
+    duplicate_groups() keywords holding the hashes hash_cache already has for paths;
+    empty if hash_cache is None
+    """
+    cache_kw = {'hashes': {}, 'partial_hashes': {}, 'durations': {}, 'block_size': block_size,
+                'algorithm': algorithm, 'cached': {}}
+    if hash_cache is not None:
+        cache_kw['hashes'].update(hash_cache.get_many(paths, algorithm))
+        cache_kw['partial_hashes'].update(
+            hash_cache.get_many(paths, f'{algorithm}_partial_{block_size}'))
+        cache_kw['cached'] = {kind: set(cache_kw[kind]) for kind in ('hashes', 'partial_hashes')}
+    return cache_kw
+
+def save_cached_hashes(hash_cache, cache_kw, close=True):
+    """
+    save the hashes computed since load_cached_hashes() to hash_cache
+    """
+    if hash_cache is None:
+        return
+    algorithm = cache_kw['algorithm']
+    partial_kind = f"{algorithm}_partial_{cache_kw['block_size']}"
+    for kind, cache_kind in (('hashes', algorithm), ('partial_hashes', partial_kind)):
+        new_hashes = {path: hash_value for path, hash_value in cache_kw[kind].items()
+                      if path not in cache_kw['cached'][kind]}
+        hash_cache.put_many(new_hashes, cache_kind)
+    if close:
+        hash_cache.close()
+
+def near_duplicates_by_id_date(items_by_id_date, groups_by_id_date, **kwargs):
+    """
+    near_duplicate_groups() of the files within each id_date that are not already
+    in one of its groups_by_id_date; returns ({id_date: groups}, {(id_date, idx): similarity})
+    """
+    candidates = []
+    for id_date, items in items_by_id_date.items():
+        grouped = {idx for group in groups_by_id_date.get(id_date, []) for idx in group[1:]}
+        remaining = [(id_date, idx) for idx in range(len(items)) if idx not in grouped]
+        if len(remaining) > 1:
+            candidates.extend(remaining)
+    paths = [items_by_id_date[id_date][idx]['src'] for id_date, idx in candidates]
+    groups, similarities = near_duplicate_groups(
+        paths, keys=[id_date for id_date, _ in candidates], max_workers=kwargs.get('max_workers', None),
+        **{k: v for k, v in kwargs.items()
+           if k in ('min_similarity', 'min_overlap', 'fingerprints', 'hash_cache')})
+
+    near_groups = defaultdict(list)
+    for group in groups:
+        near_groups[candidates[group[0]][0]].append([candidates[idx][1] for idx in group])
+    ## the best match of each file
+    best = {}
+    for pair, score in similarities.items():
+        for idx in pair:
+            best[candidates[idx]] = max(score, best.get(candidates[idx], score))
+    return near_groups, best
+
 def clean_duplicates(input_data, **kwargs):
     """
     Duplicate cleaning function for 2+ duplicates;
     Writes the destination for duplicate files.
+    With compare_fingerprint, files with the same decoded audio are duplicates too
+    (see fingerprint.py); their best match score is written as 'similarity'.
     """
     duplicate_root = kwargs.get('duplicate_root', '')
     compare_hash = kwargs.get('compare_hash', True)
     compare_duration = kwargs.get('compare_duration', True)
+    block_size = kwargs.get('block_size', 65536)
+    algorithm = kwargs.get('algorithm', DEFAULT_ALGORITHM)
+    compare_fingerprint = kwargs.get('compare_fingerprint', False)
+    hash_cache = open_hash_cache(kwargs.get('hash_cache')) if compare_hash or compare_fingerprint else None
 
-    duplicates_output = defaultdict(list)
-
-    for id_date, data in tqdm(input_data.items()):
-        items = list(data)
-        n = len(items)
-
-        # Build duplicate using groups of duplicate files
-        groups = []
-        used = set()
+    ## every id_date with 2+ files is grouped in one call, so each round of hashing
+    ## is spread across max_workers; files are only compared within their id_date
+    items_by_id_date = {id_date: list(data) for id_date, data in input_data.items()}
+    candidates = [(id_date, idx) for id_date, items in items_by_id_date.items()
+                  if len(items) > 1 for idx in range(len(items))]
+    paths = [items_by_id_date[id_date][idx]['src'] for id_date, idx in candidates]
+    ## each file is hashed and its duration read at most once per run
+    cache_kw = load_cached_hashes(hash_cache if compare_hash else None, paths, block_size, algorithm)
+    ## durations read by probe_audio_metadata are not read again
+    cache_kw['durations'].update(entry_durations(input_data))
+    groups_by_id_date = defaultdict(list)
+    for group in duplicate_groups(paths, compare_hash=compare_hash, compare_duration=compare_duration,
+                                  keys=[id_date for id_date, _ in candidates],
+                                  max_workers=kwargs.get('max_workers', None),
+                                  **hash_options(kwargs), **cache_kw):
+        groups_by_id_date[candidates[group[0]][0]].append([candidates[idx][1] for idx in group])
 
-        for i in range(n):
-            if i in used:
-                continue
+    ## re-exports and re-muxes of a recording have different bytes; optionally
+    ## group the files that are left by their decoded audio
+    similarity_by_id_date = {}
+    if compare_fingerprint:
+        near_groups, similarity_by_id_date = near_duplicates_by_id_date(
+            items_by_id_date, groups_by_id_date, **dict(kwargs, hash_cache=hash_cache))
+        for id_date, groups in near_groups.items():
+            groups_by_id_date[id_date].extend(groups)
 
-            group = {i}
-            for j in range(i + 1, n):
-                if are_duplicates(items[i], items[j], hash=compare_hash, duration=compare_duration):
-                    group.add(j)
+    duplicates_output = defaultdict(list)
 
-            if len(group) > 1:
-                used |= group # union of used and group
-                groups.append(group)
+    for id_date, items in tqdm(items_by_id_date.items()):
+        groups = groups_by_id_date.get(id_date, [])
 
         # Keep only first item in each group; mark rest as duplicates
         cleaned_items = items.copy()
 
         for group in groups:
-            group = list(group)
             keep = group[0] ## keeping only the first item in each group
             for idx in group[1:]:
                 item_dup = items[idx]
                 filename = os.path.basename(item_dup['src'])
                 item_dup['dst'] = f"{duplicate_root}/{filename}"
                 item_dup['duplicate_src'] = items[keep]['src']
+                if (id_date, idx) in similarity_by_id_date:
+                    item_dup['similarity'] = similarity_by_id_date[(id_date, idx)]
                 duplicates_output[id_date].append(item_dup)
 
                 # remove from cleaned list
@@ -123,7 +285,114 @@ def clean_duplicates(input_data, **kwargs):
         # update cleaned list
         input_data[id_date] = cleaned_items
 
+    save_cached_hashes(hash_cache if compare_hash else None, cache_kw, close=False)
+    if hash_cache is not None and not isinstance(kwargs.get('hash_cache'), HashCache):
+        hash_cache.close()
+
     return [
         {"final": input_data, "ext": "passed"},
         {"final": duplicates_output, "ext": "duplicates"}
     ]
+
+def clean_entries_of_size(clean_dataset, sizes):
+    """
+    [(id_date, entry), ...] of the clean dataset entries whose file has one of sizes.
+    A clean store, or the index of a clean_dataset.json (see query.open_index()), is read
+    by its size column, so only those entries are loaded; a dictionary is checked file by file.
+    """
+    if clean_dataset in ('', None) or len(sizes) == 0:
+        return []
+    if isinstance(clean_dataset, str):
+        if not os.path.isfile(clean_dataset):
+            return []
+        with open_index(clean_dataset) as index:
+            return index.entries_of_size(sizes)
+    found = []
+    for id_date, data in clean_dataset.items():
+        for entry in data or []:
+            try:
+                size = os.path.getsize(entry.get('dst') or entry.get('src'))
+            except (OSError, TypeError):
+                continue
+            if size in sizes:
+                found.append((id_date, entry))
+    return found
+
+def flag_archive_duplicates(input_data, **kwargs):
+    """
+    Finds files with the same contents across different id_dates, or that are already
+    in the clean dataset. Files are narrowed down by size, then partial hash, then full hash;
+    only the clean dataset files with the size of an input file are read.
+    If a file of the group is already in the clean dataset, every input file in it is
+    flagged; otherwise one input file (the first, like clean_duplicates) is kept and the
+    other copies are flagged. Flagged files list the other files of their group under
+    'archive_duplicates'. Groups within a single id_date are left to clean_duplicates. A clean dataset file that is the same file (device and inode) as
+    an input file, e.g. a hardlink, is not a duplicate of it.
+    id_dates in ignore_flagged are still compared against but never flagged.
+    """
+    clean_dataset = kwargs.get('clean_dataset', '')
+    ext = kwargs.get('ext', 'archive_duplicates')
+    ignore_flagged = kwargs.get('ignore_flagged', [])
+    block_size = kwargs.get('block_size', 65536)
+    algorithm = kwargs.get('algorithm', DEFAULT_ALGORITHM)
+    hash_cache = open_hash_cache(kwargs.get('hash_cache'))
+
+    ## (id_date, entry, in_clean_dataset, path) for every file that still exists
+    files, sizes = [], []
+    inputs = set()
+    for id_date, data in input_data.items():
+        for entry in data:
+            try:
+                stat = os.stat(entry['src'])
+            except (OSError, TypeError):
+                continue
+            inputs.add((stat.st_dev, stat.st_ino))
+            files.append((id_date, entry, False, entry['src']))
+            sizes.append(stat.st_size)
+
+    for id_date, entry in tqdm(clean_entries_of_size(clean_dataset, set(sizes))):
+        path = entry.get('dst') or entry.get('src')
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            continue
+        if (stat.st_dev, stat.st_ino) in inputs:
+            continue
+        files.append((id_date, entry, True, path))
+        sizes.append(stat.st_size)
+
+    paths = [candidate[3] for candidate in files]
+    cache_kw = load_cached_hashes(hash_cache, paths, block_size, algorithm)
+    groups = duplicate_groups(paths, compare_duration=False, sizes=sizes,
+                              max_workers=kwargs.get('max_workers', None),
+                              **hash_options(kwargs), **cache_kw)
+    save_cached_hashes(hash_cache, cache_kw, close=not isinstance(kwargs.get('hash_cache'), HashCache))
+
+    flagged = defaultdict(list)
+    for group in groups:
+        members = [files[idx] for idx in group]
+        if len({id_date for id_date, *_ in members}) == 1 and not any(m[2] for m in members):
+            continue
+        ## with no copy in the clean dataset yet, one copy goes on to be moved; a file of
+        ## an ignored id_date is never flagged, so it is the one kept if there is one
+        keep = None
+        if not any(m[2] for m in members):
+            ignored = [m for m in members if m[0] in ignore_flagged]
+            keep = (ignored or members)[0][3]
+        for id_date, entry, in_clean, path in members:
+            if in_clean or id_date in ignore_flagged or path == keep:
+                continue
+            entry['archive_duplicates'] = [{'id_date': other_id_date, 'src': other_path,
+                                            'in_clean_dataset': other_in_clean}
+                                           for other_id_date, _, other_in_clean, other_path
+                                           in members if other_path != path]
+            flagged[id_date].append(entry)
+
+    passed = defaultdict(list)
+    for id_date, data in input_data.items():
+        for entry in data:
+            if 'archive_duplicates' not in entry:
+                passed[id_date].append(entry)
+
+    return [{'final': passed, 'ext': 'passed'},
+            {'final': flagged, 'ext': ext}]
@@ -0,0 +1,159 @@
+"""
+fingerprint.py
+Decoded-audio fingerprints for finding near-duplicate recordings (re-exports, re-muxes,
+channel mixdowns) that have different bytes
+"""
+from collections import defaultdict, Counter
+import numpy as np
+from qc_scripts.audio_scan import scan_audio, scan_files
+
+FRAME_SECONDS = 0.025 ## one energy value per 25 ms, whatever the samplerate
+SMOOTH_FRAMES = 4 ## energies are averaged over 100 ms so small shifts barely change them
+WINDOW_FRAMES = 24 ## frames per sub-fingerprint (one bit per frame-to-frame change)
+
+def energy_fingerprint(energy):
+    """
+    fingerprint (smoothed dB, float32) of the per-frame energies of a recording
+    """
+    if len(energy) >= SMOOTH_FRAMES:
+        energy = np.convolve(energy, np.ones(SMOOTH_FRAMES) / SMOOTH_FRAMES, mode='valid')
+    return (10 * np.log10(energy + 1e-10)).astype(np.float32)
+
+def audio_fingerprint(path, frame_seconds=FRAME_SECONDS):
+    """
+    Per-frame energy (dB) of the mono mixdown of an audio file, decoded in blocks
+    so memory does not grow with the length of the recording (see audio_scan.py).
+    Returns a float32 array; None if the file cannot be decoded.
+    """
+    energy = scan_audio(path, fingerprint={'frame_seconds': frame_seconds})['energy']
+    return None if energy is None else energy_fingerprint(energy)
+
+def sub_fingerprints(fingerprint, window=WINDOW_FRAMES):
+    """
+    Integer keys for every window of frames: bit i is set if the energy rose between
+    frames i and i + 1. Level changes (gain, mixdown) and re-encoding keep most keys.
+    """
+    bits = np.diff(fingerprint) > 0
+    if len(bits) < window:
+        return np.zeros(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(bits, window)
+    return windows.astype(np.uint64) @ (np.uint64(1) << np.arange(window, dtype=np.uint64))
+
+def similarity(fingerprint1, fingerprint2, offset=0):
+    """
+    correlation of two fingerprints, with frame i of fingerprint1 aligned to frame
+    i + offset of fingerprint2,
+    and the fraction of the longer fingerprint that overlaps
+    """
+    start1, start2 = max(-offset, 0), max(offset, 0)
+    length = min(len(fingerprint1) - start1, len(fingerprint2) - start2)
+    if length < 2:
+        return 0.0, 0.0
+    a = fingerprint1[start1:start1 + length].astype(np.float64)
+    b = fingerprint2[start2:start2 + length].astype(np.float64)
+    a, b = a - a.mean(), b - b.mean()
+    denominator = np.sqrt(np.dot(a, a) * np.dot(b, b))
+    score = float(np.dot(a, b) / denominator) if denominator > 0 else float(np.array_equal(a, b))
+    return score, length / max(len(fingerprint1), len(fingerprint2))
+
+class FingerprintIndex:
+    """
+    Inverted index of sub-fingerprints. Every stride-th key of a file is indexed and
+    every key of a query is looked up, so a match is found at any frame offset;
+    matching keys vote for (file, offset) pairs, which avoids comparing every pair of files.
+    """
+    def __init__(self, stride=8, window=WINDOW_FRAMES):
+        self.stride = stride
+        self.window = window
+        self.table = defaultdict(list) ## key -> [(file_id, position)]
+
+    def __repr__(self):
+        return f'FingerprintIndex({len(self.table)} keys)'
+
+    def add(self, file_id, keys):
+        """
+        index the keys of a file
+        """
+        for position in range(0, len(keys), self.stride):
+            self.table[int(keys[position])].append((file_id, position))
+
+    def query(self, keys, min_votes=3):
+        """
+        {file_id: offset} of indexed files sharing at least min_votes keys at the same offset
+        """
+        votes = Counter()
+        for position, key in enumerate(keys.tolist()):
+            for file_id, indexed_position in self.table.get(key, ()):
+                votes[(file_id, position - indexed_position)] += 1
+        matches = {}
+        for (file_id, offset), count in votes.most_common():
+            if count < min_votes:
+                break
+            matches.setdefault(file_id, offset)
+        return matches
+
+def fingerprint_files(paths, max_workers=None, frame_seconds=FRAME_SECONDS, hash_cache=None):
+    """
+    {path: fingerprint} for every path that could be decoded, across a process pool;
+    max_workers=1 decodes in this process. The energies come from scan_files(), so files
+    the integrity or quality checks already decoded (in this run, or in hash_cache with
+    the same frame_seconds) are not decoded again.
+    """
+    scanned = scan_files(paths, max_workers, hash_cache, fingerprint={'frame_seconds': frame_seconds})
+    return {path: energy_fingerprint(result['energy']) for path, result in scanned.items()
+            if result['energy'] is not None}
+
+def near_duplicate_groups(paths, **kwargs):
+    """
+    Groups recordings with the same decoded audio; returns (groups, similarities).
+    groups are lists of indices into paths like duplicate_groups(), and
+    similarities is {(i, j): correlation} for the matched pairs.
+    Files are only compared within the same key (if keys are given). A pair matches if
+    its energy envelopes correlate by at least min_similarity over min_overlap of the
+    longer file. fingerprints can be a dictionary shared across calls (k=path);
+    hash_cache (a HashCache) keeps the energies fingerprints are made from across runs.
+    """
+    keys = kwargs.get('keys')
+    fingerprints = kwargs.get('fingerprints', {})
+    min_similarity = kwargs.get('min_similarity', 0.95)
+    min_overlap = kwargs.get('min_overlap', 0.9)
+    min_votes = kwargs.get('min_votes', 3)
+    stride = kwargs.get('stride', 8)
+
+    missing = [path for path in paths if path not in fingerprints]
+    fingerprints.update(fingerprint_files(missing, kwargs.get('max_workers', None),
+                                          kwargs.get('frame_seconds', FRAME_SECONDS),
+                                          kwargs.get('hash_cache')))
+
+    indices_by_key = defaultdict(list)
+    for idx, path in enumerate(paths):
+        if path in fingerprints:
+            indices_by_key[None if keys is None else keys[idx]].append(idx)
+
+    parent = list(range(len(paths)))
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    similarities = {}
+    for indices in indices_by_key.values():
+        if len(indices) < 2:
+            continue
+        index = FingerprintIndex(stride)
+        for idx in indices:
+            fingerprint = fingerprints[paths[idx]]
+            sub_keys = sub_fingerprints(fingerprint, index.window)
+            for other, offset in index.query(sub_keys, min_votes).items():
+                score, overlap = similarity(fingerprints[paths[other]], fingerprint, offset)
+                if score >= min_similarity and overlap >= min_overlap:
+                    similarities[(other, idx)] = score
+                    parent[find(idx)] = find(other)
+            index.add(idx, sub_keys)
+
+    groups = defaultdict(list)
+    for other, idx in similarities:
+        groups[find(idx)].extend([other, idx])
+    groups = [sorted(set(group)) for group in groups.values()]
+    return sorted(groups), similarities
@@ -0,0 +1,70 @@
+"""
+integrity.py
+Methods for finding unreadable, truncated and corrupt audio files
+"""
+import os
+from collections import defaultdict
+from tqdm import tqdm
+from qc_scripts.audio_scan import SUPPORTED_EXTS, scan_audio, scan_files
+from qc_scripts.utility.hash_cache import open_hash_cache, HashCache
+
+def check_audio_file(path, block_frames=65536):
+    """
+    Decodes a file block by block (memory stays at one block) and compares the frames
+    decoded to the frame count in its header.
+    Returns None if the file is intact, otherwise a dictionary with the 'integrity_error'
+    (unreadable, zero_length, truncated, decode_error or frame_count_mismatch),
+    'header_frames', 'decoded_frames' and an 'integrity_message'.
+    """
+    return scan_audio(path, block_frames)['integrity']
+
+def check_files(paths, max_workers=None, block_frames=65536, hash_cache=None,
+                measure=None, fingerprint=None):
+    """
+    {path: check_audio_file(path)} across a process pool; max_workers=1 checks in this
+    process. measure and fingerprint are computed in the same decode (see scan_files()).
+    """
+    scanned = scan_files(paths, max_workers, hash_cache, block_frames, measure, fingerprint)
+    return {path: result['integrity'] for path, result in scanned.items()}
+
+def flag_corrupt_audio(input_data, **kwargs):
+    """
+    Flags files that cannot be decoded all the way through; the reason is written to
+    'integrity_error'. Files with an extension soundfile cannot decode (e.g. m4a)
+    are passed without being checked.
+    measure (flag_audio_quality metric keywords) and fingerprint (e.g.
+    {'frame_seconds': 0.025}) have the level metrics and fingerprint energies computed
+    in the same decode, so the quality and fingerprint steps do not decode the files again.
+    """
+    ext = kwargs.get('ext', 'corrupt_audio')
+    check_exts = kwargs.get('check_exts', SUPPORTED_EXTS)
+    max_workers = kwargs.get('max_workers', None)
+    block_frames = kwargs.get('block_frames', 65536)
+    measure = kwargs.get('measure', None)
+    fingerprint = kwargs.get('fingerprint', None)
+    hash_cache = open_hash_cache(kwargs.get('hash_cache'))
+
+    paths = []
+    for data in input_data.values():
+        for entry in data:
+            if os.path.splitext(entry['src'])[1][1:].lower() in check_exts:
+                paths.append(entry['src'])
+    try:
+        results = check_files(paths, max_workers, block_frames, hash_cache, measure, fingerprint)
+    finally:
+        if hash_cache is not None and not isinstance(kwargs.get('hash_cache'), HashCache):
+            hash_cache.close()
+
+    passed = defaultdict(list)
+    flagged = defaultdict(list)
+    for id_date, data in tqdm(input_data.items()):
+        for entry in data:
+            result = results.get(entry['src'])
+            if result is None:
+                passed[id_date].append(entry)
+            else:
+                entry.update(result)
+                flagged[id_date].append(entry)
+
+    return [{'final': passed, 'ext': 'passed'},
+            {'final': flagged, 'ext': ext}]
@@ -2,25 +2,28 @@
 import os
 import json
 import types
+import shutil
 import getpass
 from pathlib import Path
 from datetime import datetime
-from qc_scripts.utility.get_latest_data import get_root_fp
+from qc_scripts.utility.get_latest_data import get_root_fp, get_registry
 from qc_scripts.utility.git import get_pipeline_origin_path, get_git_info_from_node
 from qc_scripts.utility.print import pprint_dict
 from qc_scripts.utility.read import read_dictionary_file
 from qc_scripts.utility.edit_string import append_to_end
 from qc_scripts.utility.log_helper import truncate_max_length, len_dict_list_values
+from qc_scripts.utility.ndjson import NDJSONFile
 
-def edit_static_json(static_path, log_path, ext):
+def edit_static_json(static_path, log_path, ext, commit=True):
     """
     Helper function for save log's static json rewriting
-    Reads in provided json and adds specified key:path to it before overwriting.
+    Adds specified key:path to the static json registry; if commit, the static json
+    is rewritten now, otherwise with the next commit of its registry.
     """
-    static = read_dictionary_file(static_path)
-    static[ext] = log_path
-    with open(static_path, 'w', encoding="utf-8") as fp:
-        json.dump(static, fp, indent=4)
+    registry = get_registry(static_path)
+    registry.set(ext, log_path)
+    if commit:
+        registry.commit()
 
 def custom_serializer(obj):
     """
@@ -64,23 +67,34 @@ class Logger:
             # Construct filename based on 'ext'
             size = len(data)
             nested_size = None
-            if size != 0:
+            file_ext = '.json'
+            if isinstance(data, NDJSONFile):
+                nested_size = data.n_values
+                file_ext = '.ndjson'
+            elif size != 0:
                 nested_size = len_dict_list_values(data)
             if nested_size is None:
                 filename = os.path.join(save_path,
-                                        f"{pipeline_name}_({size})_{timestamp}_{ext}.json")
+                                        f"{pipeline_name}_({size})_{timestamp}_{ext}{file_ext}")
             else:
                 filename = os.path.join(save_path,
-                                        f"{pipeline_name}_({size})_[{nested_size}]_{timestamp}_{ext}.json")
+                                        f"{pipeline_name}_({size})_[{nested_size}]_{timestamp}_{ext}{file_ext}")
 
-            # Save data to JSON file
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(data, f, default=custom_serializer, indent=4)
+            if isinstance(data, NDJSONFile):
+                # Streamed output is already on disk; move it next to the other logs
+                shutil.move(data.path, filename)
+                data.path = filename
+            else:
+                # Save data to JSON file
+                with open(filename, "w", encoding="utf-8") as f:
+                    json.dump(data, f, default=custom_serializer, indent=4)
 
             print(f"Saved log: {filename}")
             files.append(filename)
-            edit_static_json(self.static_path, filename, f"{pipeline_name}_{ext}")
+            edit_static_json(self.static_path, filename, f"{pipeline_name}_{ext}", commit=False)
 
+        ## every path of the pipeline is written to the static json at once
+        get_registry(self.static_path).commit()
         return files
 
     def log_pipeline(self, pipeline_obj, **kwargs):
@@ -3,9 +3,12 @@ move.py: move functions for files
 """
 import os
 from collections import defaultdict
-from tqdm import tqdm
 import qc_scripts.utility.move_commands as mf
 from qc_scripts.utility.read import read_dictionary_file
+from qc_scripts.utility.hash_cache import open_hash_cache, cached_file_hash, HashCache
+from qc_scripts.utility.hashing import DEFAULT_ALGORITHM
+from qc_scripts.utility.move_journal import MoveJournal, move_succeeded, copy_succeeded, is_done
+from qc_scripts.utility.move_plan import plan_moves
 
 def get_src_dst(data, move_back, **_):
     """
@@ -20,9 +23,47 @@ def get_src_dst(data, move_back, **_):
         data['src'], data['dst'] = src, dst
     return [[src, dst, data]]
 
+def verify_move(src_hash, dst, hash_cache=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    checks that dst has the hash src had before the move;
+    None if there was no src hash to compare to
+    """
+    if src_hash is None:
+        return None
+    if not os.path.isfile(dst):
+        return False
+    return cached_file_hash(dst, hash_cache, algorithm) == src_hash
+
+def status_checksum(status, algorithm=DEFAULT_ALGORITHM):
+    """
+    the checksum a move_function (e.g. checksum_copy) returned with its status, if it
+    was computed with algorithm; None otherwise
+    """
+    for value in status[3:]:
+        if isinstance(value, dict) and value.get('checksum_algorithm') == algorithm:
+            return value.get('checksum')
+    return None
+
 def move_files(input_data, **kwargs):
     """
     moving  files to their destinations
+    if verify, the hash of each file is compared before and after the move ('verified');
+    with a hash_cache, files renamed on the same device are verified without being read.
+    Files are moved on max_workers threads, with at most per_device moves per filesystem.
+    With a journal (path), every planned move is logged before it starts and every finished
+    move after it ends; if the run is interrupted, the next run with the same input only
+    moves what was not done, and rollback_journal() can undo the finished moves; a run
+    after a rollback makes the rolled back moves again.
+    Unless plan is False, every move is planned first (plan_moves): destinations claimed by
+    more than one file are not moved ('dst_collision' in move_error), and the rest run
+    without checking src and dst again. plan_only returns the plan without moving anything.
+    If stage, files are hardlinked (or reflinked, or copied across devices) to their dst
+    instead of moved ('link' in the output).
+    A move_function that returns a checksum (checksum_copy) adds it to the output, and to
+    checksums (a dictionary, k=src) if given, so update_clean_dataset() can record it.
+    Files copied or linked to their dst (stage, checksum_copy) are left where they were;
+    they are added to checksums with 'staged': True, so later runs skip the originals
+    (see clean_dataset.skip_staged()).
     """
     ## get kwargs
     move_back = kwargs.get('move_back', False)
@@ -30,6 +71,12 @@ def move_files(input_data, **kwargs):
     read_data_file = kwargs.get('read_data_file', lambda d: d)
     ## Should I allow multiple values here
     multiple_values = kwargs.get('multiple_values', True)
+    verify = kwargs.get('verify', False)
+    algorithm = kwargs.get('algorithm', DEFAULT_ALGORITHM)
+    hash_cache = open_hash_cache(kwargs.get('hash_cache')) if verify else None
+    checksums = kwargs.get('checksums')
+    journal = kwargs.get('journal')
+    plan = kwargs.get('plan', True)
 
     if isinstance(input_data, str):
         input_data = read_dictionary_file(input_data)
@@ -38,19 +85,105 @@ def move_files(input_data, **kwargs):
         ext += '_move_back'
 
     src_dst_func = kwargs.get('src_dst_func', get_src_dst)
-    move_function = mf.shutil_move if os.sep == "\\" else mf.linux_move
+    ## stage links the files into place and leaves the originals where they are
+    move_function = kwargs.get('move_function',
+                               mf.link_copy if kwargs.get('stage', False) else mf.native_move)
     final = {} if not multiple_values else defaultdict(list)
 
-    for key, value in tqdm(read_data_file(input_data).items()):
+    jobs = []
+    for key, value in read_data_file(input_data).items():
         for src, dst, data in src_dst_func(value, move_back):
-            data = dict(data)
-            status = move_function(src, dst)
-            new_key, new_value = mf.kv_status_src_dst_exist(key, data, status)
+            jobs.append((key, src, dst, dict(data)))
 
-            if multiple_values:
-                final[new_key].append(new_value)
+    ## the plan only, without moving anything
+    if kwargs.get('plan_only', False):
+        move_plan = plan_moves([(src, dst) for _, src, dst, _ in jobs], make_dirs=False)
+        return [{'final': move_plan.as_dict(), 'ext': f'{ext}_plan'}]
+
+    ## moves a previous, interrupted run finished are not repeated
+    done = {}
+    if journal is not None:
+        journal = MoveJournal(journal, kwargs.get('journal_batch_size', 100))
+        intents, done, rolled_back, finished = journal.state()
+        if finished:
+            journal.archive()
+            intents, done = {}, {}
+        ## moves a rollback undid are made again
+        done = {pair: record for pair, record in done.items() if pair not in rolled_back}
+        journal.open()
+        journal.write([{'op': 'intent', 'key': key, 'src': src, 'dst': dst}
+                       for key, src, dst, _ in jobs
+                       if src is not None and (src, dst) not in intents], sync=True)
+
+    def move_one(src, dst, status=None):
+        ## hash, move and verify one file; run on the move threads.
+        ## status is given for pairs the plan resolved without a move
+        if verify:
+            src_hash = cached_file_hash(src, hash_cache, algorithm) if os.path.isfile(src) else None
+        if status is None:
+            status = move_function(src, dst, **move_function_kw)
+        verified = None
+        if verify:
+            ## a checksum taken while copying saves reading dst again
+            checksum = status_checksum(status, algorithm)
+            if checksum is not None and src_hash is not None:
+                verified = checksum == src_hash
             else:
-                assert new_key not in final, f"{new_key}, {new_value}"
-                final[new_key] = new_value
+                verified = verify_move(src_hash, dst, hash_cache, algorithm)
+        if journal is not None and src is not None:
+            journal.write([{'op': 'done', 'src': src, 'dst': dst,
+                            'moved': move_succeeded(status), 'copied': copy_succeeded(status),
+                            'result': [status, verified]}])
+        return status, verified
+
+    ## moves that failed (or found nothing to move) last time are tried again
+    todo = list(dict.fromkeys((src, dst) for _, src, dst, _ in jobs
+                              if (src, dst) not in done or not is_done(done[(src, dst)])))
+    move_function_kw = {}
+    try:
+        moved = {}
+        if plan:
+            ## collisions, missing sources and existing destinations are found up front,
+            ## and folders are made once, so the moves run without checks of their own;
+            ## a dst made since the plan is still never replaced (rename_no_replace)
+            move_plan = plan_moves(todo)
+            if len(move_plan.collisions) > 0:
+                print(f'{len(move_plan.collisions)} destinations are claimed by more than one '
+                      'file; these files were not moved (see move_error)')
+            moved.update({pair: move_one(*pair, status=status)
+                          for pair, status in move_plan.skipped.items()})
+            todo = move_plan.moves
+            move_function_kw['checked'] = True
+        moved.update(zip(todo, mf.concurrent_moves(todo, move_one,
+                                                   max_workers=kwargs.get('max_workers', 8),
+                                                   per_device=kwargs.get('per_device', 4))))
+        if journal is not None:
+            journal.write([{'op': 'finished'}], sync=True)
+    finally:
+        ## an interrupted run still syncs the moves it finished
+        if journal is not None:
+            journal.close()
+    results = [moved[(src, dst)] if (src, dst) in moved else done[(src, dst)]['result']
+               for _, src, dst, _ in jobs]
+
+    ## results are in the order of the input, however the moves finished
+    for (key, _, _, data), (status, verified) in zip(jobs, results):
+        new_key, new_value = mf.kv_status_src_dst_exist(key, data, status)
+        if verify:
+            new_value['verified'] = verified
+        if checksums is not None and 'checksum' in new_value:
+            checksums[new_value['src']] = {'checksum': new_value['checksum'],
+                                           'checksum_algorithm': new_value['checksum_algorithm']}
+        if checksums is not None and copy_succeeded(status):
+            checksums.setdefault(new_value['src'], {})['staged'] = True
+
+        if multiple_values:
+            final[new_key].append(new_value)
+        else:
+            assert new_key not in final, f"{new_key}, {new_value}"
+            final[new_key] = new_value
+
+    if hash_cache is not None and not isinstance(kwargs.get('hash_cache'), HashCache):
+        hash_cache.close()
 
     return [{'final': final, 'ext': ext}]
@@ -0,0 +1,123 @@
+"""
+probe.py
+Reads audio metadata (duration, samplerate, channels, format, subtype) from file headers
+once per file, so later steps do not have to reopen the files
+"""
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import soundfile as sf
+from qc_scripts.utility.hash_cache import open_hash_cache, HashCache
+from qc_scripts.utility.ndjson import NDJSONFile, write_ndjson_line
+from qc_scripts.utility.read import dictionary_items
+
+CACHE_KIND = 'audio_info'
+
+def probe_audio(path):
+    """
+    header-only metadata of an audio file; {'error': message} if soundfile cannot read it
+    """
+    try:
+        info = sf.info(path)
+    except Exception as e:
+        return {'error': str(e)}
+    return {'duration': info.frames / info.samplerate if info.samplerate else None,
+            'frames': info.frames,
+            'samplerate': info.samplerate,
+            'channels': info.channels,
+            'format': info.format,
+            'subtype': info.subtype}
+
+def probe_files(paths, max_workers=None, hash_cache=None):
+    """
+    {path: probe_audio(path)} across a process pool; results are read from and saved
+    to hash_cache (as JSON) so unchanged files are only probed once.
+    max_workers=1 probes in this process.
+    """
+    paths = list(dict.fromkeys(paths))
+    info = {}
+    if hash_cache is not None:
+        info.update({path: json.loads(value)
+                     for path, value in hash_cache.get_many(paths, CACHE_KIND).items()})
+    missing = [path for path in paths if path not in info]
+    if max_workers == 1 or len(missing) <= 1:
+        probed = [probe_audio(path) for path in missing]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            probed = list(executor.map(probe_audio, missing, chunksize=16))
+    info.update(zip(missing, probed))
+    if hash_cache is not None:
+        ## errors are not cached, so they are retried on the next run
+        hash_cache.put_many({path: json.dumps(result) for path, result in zip(missing, probed)
+                             if 'error' not in result}, CACHE_KIND)
+    return info
+
+def as_entries(data):
+    """
+    the entries of a key, whether or not the walk kept multiple values
+    """
+    return data if isinstance(data, list) else [data]
+
+def id_date_batches(input_data, batch_size):
+    """
+    yields lists of (id_date, data) with about batch_size files each
+    """
+    batch, n_files = [], 0
+    for id_date, data in dictionary_items(input_data):
+        batch.append((id_date, data))
+        n_files += len(as_entries(data))
+        if n_files >= batch_size:
+            yield batch
+            batch, n_files = [], 0
+    if len(batch) > 0:
+        yield batch
+
+def probe_audio_metadata(input_data, **kwargs):
+    """
+    Adds the audio metadata of each file to its entry under key (default 'audio').
+    Files are probed batch_size at a time; if the input is a streamed walk (.ndjson)
+    the output is streamed to the same file.
+    """
+    ext = kwargs.get('ext', 'walk')
+    key = kwargs.get('key', 'audio')
+    max_workers = kwargs.get('max_workers', None)
+    batch_size = kwargs.get('batch_size', 10000)
+    hash_cache = open_hash_cache(kwargs.get('hash_cache'))
+
+    stream_path = None
+    if isinstance(input_data, NDJSONFile):
+        stream_path, input_data = input_data.path, input_data.path
+
+    final = {}
+    n_keys, n_values = 0, 0
+    f = open(f'{stream_path}.tmp', 'w', encoding='utf-8') if stream_path is not None else None
+    try:
+        for batch in id_date_batches(input_data, batch_size):
+            info = probe_files([entry['src'] for _, data in batch for entry in as_entries(data)],
+                               max_workers, hash_cache)
+            for id_date, data in batch:
+                for entry in as_entries(data):
+                    entry[key] = info[entry['src']]
+                if f is not None:
+                    write_ndjson_line(f, id_date, data)
+                    n_keys += 1
+                    n_values += len(as_entries(data))
+                else:
+                    final[id_date] = data
+    finally:
+        if f is not None:
+            f.close()
+        if hash_cache is not None and not isinstance(kwargs.get('hash_cache'), HashCache):
+            hash_cache.close()
+
+    if stream_path is not None:
+        os.replace(f'{stream_path}.tmp', stream_path)
+        final = NDJSONFile(stream_path, n_keys, n_values)
+    return [{'final': final, 'ext': ext}]
+
+def entry_durations(input_data, key='audio'):
+    """
+    {src: duration} from the metadata added by probe_audio_metadata (None if unreadable)
+    """
+    return {entry['src']: entry[key].get('duration')
+            for data in input_data.values() for entry in as_entries(data) if key in entry}
@@ -0,0 +1,86 @@
+"""
+quality.py
+Methods for flagging recordings that are mostly silent, clipped or too quiet
+"""
+import os
+from collections import defaultdict
+from tqdm import tqdm
+from qc_scripts.audio_scan import SUPPORTED_EXTS, scan_audio, scan_files
+from qc_scripts.utility.hash_cache import open_hash_cache, HashCache
+
+## keywords of audio_metrics() that change the metrics
+METRIC_KEYS = ('frame_seconds', 'silence_dbfs', 'clip_level')
+
+def audio_metrics(path, block_frames=65536, frame_seconds=0.05, silence_dbfs=-60.0,
+                  clip_level=0.999):
+    """
+    RMS and peak level (dBFS), the fraction of samples at or above clip_level and the
+    fraction of frame_seconds frames quieter than silence_dbfs, computed block by block.
+    Returns None if the file cannot be decoded.
+    """
+    measure = {'frame_seconds': frame_seconds, 'silence_dbfs': silence_dbfs, 'clip_level': clip_level}
+    return scan_audio(path, block_frames, measure=measure)['quality']
+
+def measure_files(paths, max_workers=None, hash_cache=None, **kwargs):
+    """
+    {path: audio_metrics(path)} across a process pool; max_workers=1 measures in this process.
+    The metrics come from scan_files(), so files flag_corrupt_audio already measured
+    with the same keywords (in this run, or in hash_cache) are not decoded again.
+    """
+    measure = {k: v for k, v in kwargs.items() if k in METRIC_KEYS}
+    scanned = scan_files(paths, max_workers, hash_cache, kwargs.get('block_frames', 65536), measure)
+    return {path: result['quality'] for path, result in scanned.items()}
+
+def quality_flags(metrics, max_silence_ratio=0.9, max_clipping_ratio=0.001, min_rms_dbfs=-50.0):
+    """
+    reasons a file fails the thresholds: mostly_silent, clipped and/or too_quiet
+    """
+    flags = []
+    if metrics['silence_ratio'] > max_silence_ratio:
+        flags.append('mostly_silent')
+    if metrics['clipping_ratio'] > max_clipping_ratio:
+        flags.append('clipped')
+    if metrics['rms_dbfs'] is None or metrics['rms_dbfs'] < min_rms_dbfs:
+        flags.append('too_quiet')
+    return flags
+
+def flag_audio_quality(input_data, **kwargs):
+    """
+    Adds the RMS, peak, clipping ratio and silence ratio of each file to its entry
+    under 'quality', and flags files that are mostly silent, clipped or too quiet
+    (listed in 'quality_flags'). Files soundfile cannot decode are passed without metrics.
+    Files flag_corrupt_audio measured with the same metric keywords are not decoded again.
+    """
+    ext = kwargs.get('ext', 'flagged_quality')
+    check_exts = kwargs.get('check_exts', SUPPORTED_EXTS)
+    max_workers = kwargs.get('max_workers', None)
+    metric_kwargs = {k: v for k, v in kwargs.items() if k in ('block_frames',) + METRIC_KEYS}
+    threshold_kwargs = {k: v for k, v in kwargs.items()
+                        if k in ('max_silence_ratio', 'max_clipping_ratio', 'min_rms_dbfs')}
+
+    paths = [entry['src'] for data in input_data.values() for entry in data
+             if os.path.splitext(entry['src'])[1][1:].lower() in check_exts]
+    hash_cache = open_hash_cache(kwargs.get('hash_cache'))
+    try:
+        metrics = measure_files(paths, max_workers, hash_cache, **metric_kwargs)
+    finally:
+        if hash_cache is not None and not isinstance(kwargs.get('hash_cache'), HashCache):
+            hash_cache.close()
+
+    passed = defaultdict(list)
+    flagged = defaultdict(list)
+    for id_date, data in tqdm(input_data.items()):
+        for entry in data:
+            if metrics.get(entry['src']) is None:
+                passed[id_date].append(entry)
+                continue
+            entry['quality'] = metrics[entry['src']]
+            flags = quality_flags(entry['quality'], **threshold_kwargs)
+            if len(flags) > 0:
+                entry['quality_flags'] = flags
+                flagged[id_date].append(entry)
+            else:
+                passed[id_date].append(entry)
+
+    return [{'final': passed, 'ext': 'passed'},
+            {'final': flagged, 'ext': ext}]
@@ -0,0 +1,117 @@
+"""
+query.py
+Filtered, paginated reads of the clean dataset that do not load the whole dataset.
+Queries run against the indexes of the clean store; a clean_dataset.json is indexed
+once into a SQLite file next to it, which is rebuilt when the JSON changes.
+"""
+import os
+from datetime import date
+from qc_scripts.clean_store import CleanStore, is_clean_store
+from qc_scripts.utility.get_latest_data import get_filepath
+from qc_scripts.utility.read import read_dictionary_file
+
+## filters matched against an indexed column of the store
+COLUMN_FILTERS = ('pid', 'id_date', 'tester_id', 'location')
+
+def as_list(value):
+    """
+    a single filter value or a list of values as a list
+    """
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+def as_date(value):
+    """
+    YYYYMMDD string of a date, as the dates are written in the clean dataset
+    """
+    return value.strftime('%Y%m%d') if isinstance(value, date) else str(value)
+
+def build_where(**filters):
+    """
+    (where clause, params) for the filters:
+        pid, id_date, tester_id, location: a value or a list of values
+        start_date, end_date: inclusive range of recording dates (date or 'YYYYMMDD')
+        ext: file extension(s) of src, e.g. 'wav' or ['wav', 'flac']
+    """
+    unknown = set(filters) - set(COLUMN_FILTERS) - {'start_date', 'end_date', 'ext'}
+    if len(unknown) > 0:
+        raise TypeError(f'Unknown filters: {sorted(unknown)}')
+    clauses, params = [], []
+    for name in COLUMN_FILTERS:
+        if filters.get(name) is None:
+            continue
+        values = [str(value) for value in as_list(filters[name])]
+        clauses.append(f"{name} IN ({','.join('?' * len(values))})")
+        params.extend(values)
+    if filters.get('start_date') is not None:
+        clauses.append('date >= ?')
+        params.append(as_date(filters['start_date']))
+    if filters.get('end_date') is not None:
+        clauses.append('date <= ?')
+        params.append(as_date(filters['end_date']))
+    if filters.get('ext') is not None:
+        exts = [f".{ext.lstrip('.').lower()}" for ext in as_list(filters['ext'])]
+        clauses.append(' OR '.join(['lower(src) LIKE ?'] * len(exts)))
+        params.extend(f'%{ext}' for ext in exts)
+    return ' AND '.join(f'({clause})' for clause in clauses) or '1', params
+
+def open_index(clean_dataset=None):
+    """
+    CleanStore to query: the clean store itself, or the index of a clean_dataset.json
+    (<name>.index.sqlite3), rebuilt if it is older than the JSON (keeping the file
+    sizes the old index had read).
+    clean_dataset defaults to the 'clean_dataset' path in static.json.
+    """
+    if clean_dataset is None:
+        clean_dataset = get_filepath('clean_dataset')
+    if is_clean_store(clean_dataset):
+        return CleanStore(clean_dataset)
+
+    index_path = f'{os.path.splitext(clean_dataset)[0]}.index.sqlite3'
+    if not os.path.isfile(index_path) or \
+            os.path.getmtime(index_path) < os.path.getmtime(clean_dataset):
+        data = read_dictionary_file(clean_dataset)
+        tmp = f'{index_path}.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with CleanStore(tmp) as index:
+            index.add(data)
+            ## file sizes read for the last index are kept
+            if os.path.isfile(index_path):
+                index.copy_sizes(index_path)
+        os.replace(tmp, index_path)
+    return CleanStore(index_path)
+
+def iter_entries(clean_dataset=None, page_size=1000, **filters):
+    """
+    yields the clean dataset entries matching the filters (see build_where()),
+    reading page_size entries at a time
+    """
+    where, params = build_where(**filters)
+    with open_index(clean_dataset) as index:
+        after = 0
+        while True:
+            rows = index.select(where, params, after, page_size)
+            for _, entry in rows:
+                yield entry
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+
+def query_page(clean_dataset=None, after=0, page_size=100, **filters):
+    """
+    one page of the entries matching the filters:
+    {'entries': [...], 'next': cursor for the next page, or None on the last page}
+    """
+    where, params = build_where(**filters)
+    with open_index(clean_dataset) as index:
+        rows = index.select(where, params, after, page_size + 1)
+    next_after = rows[page_size - 1][0] if len(rows) > page_size else None
+    return {'entries': [entry for _, entry in rows[:page_size]], 'next': next_after}
+
+def count_entries(clean_dataset=None, **filters):
+    """
+    number of entries matching the filters
+    """
+    where, params = build_where(**filters)
+    with open_index(clean_dataset) as index:
+        return index.count_where(where, params)
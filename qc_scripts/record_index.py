@@ -0,0 +1,81 @@
+"""
+record_index.py
+Index over the validated records for id_date lookups and nearest record searches
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+from qc_scripts.utility.read import read_dictionary_file
+
+def split_id_date(id_date):
+    """
+    split an id_date into its pid and date string
+    """
+    pid, _, date = id_date.rpartition('_')
+    return pid, date
+
+class RecordIndex:
+    """
+    Built once from the validated records (k=id_date, v=record).
+    Exact id_date lookups go through the records dictionary; each pid also keeps a
+    sorted list of its record dates so nearby records are found with bisect.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.dates = defaultdict(list) ## pid -> sorted [(date, id_date)]
+        self.invalid_dates = defaultdict(list) ## pid -> [id_date] with unparsable dates
+        for id_date in records:
+            pid, date = split_id_date(id_date)
+            try:
+                self.dates[pid].append((datetime.strptime(date, "%Y%m%d").date(), id_date))
+            except ValueError:
+                self.invalid_dates[pid].append(id_date)
+        for dates in self.dates.values():
+            dates.sort()
+        self.sorted_dates = {pid: [d for d, _ in dates] for pid, dates in self.dates.items()}
+
+    def __repr__(self):
+        return f'RecordIndex({len(self.records)} records)'
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, id_date):
+        return id_date in self.records
+
+    def __getitem__(self, id_date):
+        return self.records[id_date]
+
+    def get(self, id_date, default=None):
+        """
+        record for an id_date
+        """
+        return self.records.get(id_date, default)
+
+    def nearest(self, pid, date, window_days=None):
+        """
+        records for pid dated within window_days of date (all of them if window_days is None);
+        returns (id_date, difference in days) in date order. Records with unparsable dates
+        are only included when there is no window, with a difference of 'Error'.
+        """
+        dates = self.dates.get(pid, [])
+        start, end = 0, len(dates)
+        if window_days is not None:
+            window = timedelta(days=window_days)
+            start = bisect_left(self.sorted_dates[pid], date - window) if dates else 0
+            end = bisect_right(self.sorted_dates[pid], date + window) if dates else 0
+        nearest = [(id_date, abs((record_date - date).days))
+                   for record_date, id_date in dates[start:end]]
+        if window_days is None:
+            nearest.extend((id_date, 'Error') for id_date in self.invalid_dates.get(pid, []))
+        return nearest
+
+def get_record_index(records, **kwargs):
+    """
+    get a RecordIndex from a RecordIndex, a records dictionary or a path to one
+    """
+    if isinstance(records, RecordIndex):
+        return records
+    if isinstance(records, str):
+        records = read_dictionary_file(records, **kwargs)
+    return RecordIndex(records)
@@ -0,0 +1,222 @@
+"""
+snapshots.py
+Versioned history of the clean dataset. Each version stores only the id_dates that
+were added or changed, as content-addressed objects, and the versions form a hash chain.
+"""
+import os
+import json
+import hashlib
+from datetime import datetime
+
+## commit() value of an id_date that was removed; written as null in the version record.
+## An id_date whose entries are None is kept, as the object of null.
+REMOVED = object()
+
+def content_hash(data, sort_keys=True):
+    """
+    sha256 of the JSON of an id_date's entries (the object's address); keys are sorted
+    so the same entries hash the same whatever order their keys were written in
+    (sort_keys=False gives the address objects were stored under before)
+    """
+    return hashlib.sha256(json.dumps(data, sort_keys=sort_keys).encode('utf-8')).hexdigest()
+
+def read_last_line(path, block_size=65536):
+    """
+    the last non-empty line of a file, read from its end; None if there is none
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        tail = b''
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            tail = f.read(end - start) + tail
+            end = start
+            lines = tail.rstrip(b'\n').rsplit(b'\n', 1)
+            if len(lines) > 1 or end == 0:
+                line = lines[-1].strip()
+                return line.decode('utf-8') if line != b'' else None
+    return None
+
+def record_hash(parent, changes):
+    """
+    hash of a version: its changes chained to the hash of the version before
+    """
+    payload = json.dumps({'parent': parent, 'changes': changes}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class SnapshotLog:
+    """
+    root/objects/<ab>/<hash>.json: the entries of one id_date, stored once per content
+    root/versions.ndjson: one line per version,
+        {'version', 'time', 'parent', 'hash', 'changes': {id_date: object hash, or null if removed}}
+    Version 0 holds every id_date of the dataset when the history was started.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.versions_path = os.path.join(root, 'versions.ndjson')
+        ## latest version record; read from the end of versions.ndjson once
+        self.last = None
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def __repr__(self):
+        return f'SnapshotLog({self.root!r})'
+
+    def object_path(self, hash_value):
+        """
+        path of an object
+        """
+        return os.path.join(self.root, 'objects', hash_value[:2], f'{hash_value}.json')
+
+    def put_object(self, data):
+        """
+        store the entries of an id_date if they are not stored yet; returns the hash
+        """
+        hash_value = content_hash(data)
+        path = self.object_path(hash_value)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(f'{path}.tmp', path)
+        return hash_value
+
+    def get_object(self, hash_value):
+        """
+        the entries stored under hash_value
+        """
+        with open(self.object_path(hash_value), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def versions(self):
+        """
+        every version record, oldest first
+        """
+        if not os.path.isfile(self.versions_path):
+            return []
+        with open(self.versions_path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip() != '']
+
+    def head(self):
+        """
+        the latest version record, or None before the first snapshot;
+        only the last line of versions.ndjson is read, and it is kept after that
+        """
+        if self.last is None:
+            line = read_last_line(self.versions_path)
+            self.last = None if line is None else json.loads(line)
+        return self.last
+
+    def commit(self, changes):
+        """
+        record a version from {id_date: entries, or REMOVED if removed};
+        returns the record, or None if there were no changes
+        """
+        if len(changes) == 0:
+            return None
+        head = self.head()
+        changes = {id_date: None if data is REMOVED else self.put_object(data)
+                   for id_date, data in changes.items()}
+        parent = None if head is None else head['hash']
+        record = {'version': 0 if head is None else head['version'] + 1,
+                  'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                  'parent': parent,
+                  'hash': record_hash(parent, changes),
+                  'changes': changes}
+        with open(self.versions_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record))
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.last = record
+        return record
+
+    def start(self, data):
+        """
+        record the whole dataset as version 0 if there is no history yet
+        """
+        if len(data) > 0 and self.head() is None:
+            self.commit(data)
+
+    def remove(self, id_dates):
+        """
+        record a version without id_dates; returns the record or None
+        """
+        return self.commit({id_date: REMOVED for id_date in id_dates})
+
+    def commit_changed(self, before, after):
+        """
+        commit the id_dates of after ({id_date: entries}) whose content hash differs
+        from before ({id_date: content_hash}, without the id_dates that were not there);
+        returns the record or None
+        """
+        return self.commit({id_date: data for id_date, data in after.items()
+                            if content_hash(data) != before.get(id_date)})
+
+    def manifest(self, version=None):
+        """
+        {id_date: object hash} of a version (default: the latest), in dataset order;
+        only the version records are read
+        """
+        manifest = {}
+        for record in self.versions():
+            if version is not None and record['version'] > version:
+                break
+            for id_date, hash_value in record['changes'].items():
+                if hash_value is None:
+                    manifest.pop(id_date, None)
+                else:
+                    manifest[id_date] = hash_value
+        return manifest
+
+    def rebuild(self, version=None):
+        """
+        the clean dataset as it was at a version (default: the latest)
+        """
+        return {id_date: self.get_object(hash_value)
+                for id_date, hash_value in self.manifest(version).items()}
+
+    def diff(self, version1, version2=None):
+        """
+        {'added', 'removed', 'changed'}: id_dates that differ between two versions,
+        found by comparing object hashes without reading the objects
+        """
+        before, after = self.manifest(version1), self.manifest(version2)
+        return {'added': [id_date for id_date in after if id_date not in before],
+                'removed': [id_date for id_date in before if id_date not in after],
+                'changed': [id_date for id_date in after
+                            if id_date in before and before[id_date] != after[id_date]]}
+
+    def verify(self):
+        """
+        True if every version chains to the one before it and its objects are intact;
+        objects stored before content_hash() sorted keys are checked by their old address
+        """
+        parent = None
+        for record in self.versions():
+            if record['parent'] != parent or \
+                    record['hash'] != record_hash(parent, record['changes']):
+                return False
+            for hash_value in record['changes'].values():
+                if hash_value is None:
+                    continue
+                data = self.get_object(hash_value)
+                if hash_value not in (content_hash(data), content_hash(data, sort_keys=False)):
+                    return False
+            parent = record['hash']
+        return True
+
+def open_snapshots(snapshots=None, clean_dataset=''):
+    """
+    get a SnapshotLog from a SnapshotLog or a folder; None (default) uses the
+    'snapshots' folder next to clean_dataset, and False keeps no history
+    """
+    if snapshots is False:
+        return None
+    if isinstance(snapshots, SnapshotLog):
+        return snapshots
+    if snapshots is None:
+        snapshots = os.path.join(os.path.dirname(clean_dataset), 'snapshots')
+    return SnapshotLog(snapshots)
@@ -108,6 +108,34 @@ class FilterNode(Node):
     -- currently not in use, but leaving in case we want to re-implemet it
     """
 
+class FusedFilterNode(FilterNode):
+    """
+    Subclass of FilterNode for functions that run several checks in one pass over the data
+    (e.g. compare_records.check_records). Results tagged with a 'func_name' are written by
+    write_output_func under that name, the same as if each check were its own node;
+    write_output_checks limits which checks are written (default: all of them).
+    """
+    def process(self, state):
+        self.start_time = datetime.now()
+        input_data = state.get(self.input_key, None)
+        results = self.execute_func(input_data)
+
+        state_updates = defaultdict(lambda: defaultdict)
+        check_updates = defaultdict(dict)
+        for result in results:
+            key = result['ext']
+            value = result['final']
+            state_updates[key] = value
+            check_updates[result.get('func_name', self.name)][key] = value
+        if self.write_output_func is not None:
+            write_output_kw = self.kwargs.get('write_output_kw', {})
+            write_output_checks = self.kwargs.get('write_output_checks', list(check_updates))
+            for func_name, updates in check_updates.items():
+                if func_name in write_output_checks:
+                    self.write_output_func(input_data, updates, func_name, **write_output_kw)
+        self.end_time = datetime.now()
+        return state_updates
+
 class MergeNode(Node):
     """
     Subclass of Node that allows for combining data from two pipelines / sources
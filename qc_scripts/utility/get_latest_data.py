@@ -3,16 +3,105 @@ get_latest_data.py
 get latest data JSON paths
 based of get_latest_data from fhs_dcdt_quality_control repo
 """
+import os
+import json
+import threading
 from qc_scripts.utility.read import read_dictionary_file
 
+class JSONRegistry:
+    """
+    A JSON file of key: value (static.json, config.json) read once per process.
+    Lookups reuse the loaded file until its inode, mtime or size changes.
+    set() keeps updates in memory (visible to get()) until commit() writes them all
+    in one atomic write: a temporary file renamed over the original.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.data = None
+        self.stamp = None
+        self.pending = {}
+
+    def __repr__(self):
+        return f'JSONRegistry({self.path!r}, {len(self.pending)} pending)'
+
+    def file_stamp(self):
+        """
+        (inode, mtime_ns, size) of the file; None if it does not exist
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """
+        the file's contents, read again only if the file changed since the last read
+        """
+        stamp = self.file_stamp()
+        if self.data is None or stamp != self.stamp:
+            self.data = read_dictionary_file(self.path)
+            self.stamp = stamp
+        return self.data
+
+    def get(self, key):
+        """
+        value of key, including updates that are not committed yet
+        """
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            return self.load()[key]
+
+    def set(self, key, value):
+        """
+        update key in memory; written by the next commit()
+        """
+        with self.lock:
+            self.pending[key] = value
+
+    def commit(self):
+        """
+        write the pending updates over the latest contents of the file in one atomic write
+        """
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            data = dict(self.load())
+            data.update(self.pending)
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w', encoding="utf-8") as fp:
+                json.dump(data, fp, indent=4)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.path)
+            self.data = data
+            self.stamp = self.file_stamp()
+            self.pending = {}
+
+## one registry per file per process
+REGISTRIES = {}
+REGISTRIES_LOCK = threading.Lock()
+
+def get_registry(path):
+    """
+    the JSONRegistry of path, shared by every caller in this process
+    """
+    with REGISTRIES_LOCK:
+        key = os.path.abspath(path)
+        if key not in REGISTRIES:
+            REGISTRIES[key] = JSONRegistry(key)
+        return REGISTRIES[key]
+
 def get_filepath(key, static_json="static.json"):
     """
     get filepath associated with key
     """
-    return read_dictionary_file(static_json)[key]
+    return get_registry(static_json).get(key)
 
 def get_root_fp(key, static_json="config.json"):
     """
     get filepath associated with key
     """
-    return read_dictionary_file(static_json)[key]
+    return get_registry(static_json).get(key)
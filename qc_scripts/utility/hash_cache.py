@@ -0,0 +1,206 @@
+"""
+hash_cache.py
+SQLite cache of file content hashes shared across runs
+"""
+import os
+import time
+import sqlite3
+import threading
+import functools
+from qc_scripts.utility.get_latest_data import get_root_fp
+from qc_scripts.utility.hashing import file_hash, DEFAULT_ALGORITHM
+
+## stay under SQLite's default limit on query parameters
+LOOKUP_CHUNK = 500
+## eviction drops entries down to this share of max_entries, so it runs once per
+## many puts rather than on every put of a full cache
+EVICT_TO = 0.9
+
+def file_identity(path):
+    """
+    (device, inode, size, mtime_ns) of a file; None if it cannot be stat'ed
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+def locked(method):
+    """
+    run a HashCache method while holding its lock
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class HashCache:
+    """
+    Content hashes keyed on (device, inode, size, mtime_ns) and the kind of hash
+    (the hash algorithm, e.g. 'md5' or 'blake2b', or 'md5_partial_65536' for first/last block hashes).
+    An entry only matches while the file's size and mtime are unchanged, so edited
+    files are re-hashed; a file that is renamed on the same device keeps its entry.
+    Once there are more than max_entries rows, the least recently used are evicted
+    (down to EVICT_TO of max_entries).
+    The number of rows is counted once when the cache is opened and then kept as an
+    upper bound (replaced rows are counted again), so puts do not count the table.
+    Other per-file values can be kept under their own kind as text (e.g. 'audio_info' JSON),
+    or in their own table of the same database (e.g. audio_scan.py's decode results), so
+    they do not share the eviction of the content hashes.
+    """
+    def __init__(self, path, max_entries=1000000, table='hashes'):
+        parent = os.path.dirname(path)
+        if parent != '':
+            os.makedirs(parent, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        ## shared by the move threads; every use of the connection holds the lock
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+            dev INTEGER, inode INTEGER, kind TEXT, size INTEGER, mtime_ns INTEGER,
+            hash TEXT, last_used REAL, PRIMARY KEY (dev, inode, kind))''')
+        self.connection.execute(
+            f'CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)')
+        ## get_many() looks files up by kind and inode; the primary key starts with dev
+        self.connection.execute(
+            f'CREATE INDEX IF NOT EXISTS {table}_kind_inode ON {table} (kind, inode)')
+        self.connection.commit()
+        self.rows = self.connection.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def __repr__(self):
+        if self.table != 'hashes':
+            return f'HashCache({self.path!r}, table={self.table!r})'
+        return f'HashCache({self.path!r})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @locked
+    def close(self):
+        """
+        close the database connection
+        """
+        self.connection.close()
+
+    @locked
+    def get_many(self, paths, kind='md5'):
+        """
+        bulk lookup; returns {path: hash} for the paths with a valid entry
+        """
+        identities = {}
+        for path in paths:
+            identity = file_identity(path)
+            if identity is not None:
+                identities[path] = identity
+        by_inode = {}
+        for path, (dev, inode, size, mtime_ns) in identities.items():
+            by_inode.setdefault(inode, []).append((path, dev, size, mtime_ns))
+
+        found = {}
+        used = []
+        inodes = list(by_inode)
+        for start in range(0, len(inodes), LOOKUP_CHUNK):
+            chunk = inodes[start:start + LOOKUP_CHUNK]
+            rows = self.connection.execute(
+                f'''SELECT dev, inode, size, mtime_ns, hash FROM {self.table}
+                    WHERE kind = ? AND inode IN ({','.join('?' * len(chunk))})''',
+                [kind] + chunk)
+            for dev, inode, size, mtime_ns, hash_value in rows:
+                for path, path_dev, path_size, path_mtime_ns in by_inode[inode]:
+                    if (dev, size, mtime_ns) == (path_dev, path_size, path_mtime_ns):
+                        found[path] = hash_value
+                        used.append((dev, inode))
+        if used:
+            now = time.time()
+            self.connection.executemany(
+                f'UPDATE {self.table} SET last_used = ? WHERE dev = ? AND inode = ? AND kind = ?',
+                [(now, dev, inode, kind) for dev, inode in used])
+            self.connection.commit()
+        return found
+
+    def get(self, path, kind='md5'):
+        """
+        hash of a single file, or None if it is not cached
+        """
+        return self.get_many([path], kind).get(path)
+
+    @locked
+    def put_many(self, path_hashes, kind='md5'):
+        """
+        store {path: hash}; replaces any older entry for the same file
+        """
+        now = time.time()
+        rows = []
+        for path, hash_value in path_hashes.items():
+            identity = file_identity(path)
+            if identity is None:
+                continue
+            dev, inode, size, mtime_ns = identity
+            rows.append((dev, inode, kind, size, mtime_ns, hash_value, now))
+        self.connection.executemany(
+            f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+        self.rows += len(rows)
+        if self.rows > self.max_entries:
+            self.evict()
+
+    def put(self, path, hash_value, kind='md5'):
+        """
+        store the hash of a single file
+        """
+        self.put_many({path: hash_value}, kind)
+
+    @locked
+    def evict(self):
+        """
+        drop the least recently used entries down to EVICT_TO of max_entries; put_many()
+        calls this once its count of rows passes max_entries
+        """
+        self.rows = self.connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        keep = int(self.max_entries * EVICT_TO)
+        if self.rows <= keep:
+            return
+        self.connection.execute(
+            f'''DELETE FROM {self.table} WHERE rowid IN
+               (SELECT rowid FROM {self.table} ORDER BY last_used LIMIT ?)''',
+            (self.rows - keep,))
+        self.connection.commit()
+        self.rows = keep
+
+def open_hash_cache(hash_cache=None, **kwargs):
+    """
+    get a HashCache from a HashCache or a path to the database.
+    If hash_cache is None, the 'hash_cache' path in config.json is used if it is set;
+    returns None if there is no cache (or hash_cache is False).
+    """
+    if hash_cache is False:
+        return None
+    if isinstance(hash_cache, HashCache):
+        return hash_cache
+    if hash_cache is None:
+        try:
+            hash_cache = get_root_fp('hash_cache')
+        except (KeyError, FileNotFoundError):
+            return None
+    if hash_cache in ('', None):
+        return None
+    return HashCache(hash_cache, **kwargs)
+
+def cached_file_hash(path, hash_cache=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    file_hash(path), read from and saved to hash_cache if one is given
+    """
+    if hash_cache is None:
+        return file_hash(path, algorithm)
+    hash_value = hash_cache.get(path, algorithm)
+    if hash_value is None:
+        hash_value = file_hash(path, algorithm)
+        hash_cache.put(path, hash_value, algorithm)
+    return hash_value
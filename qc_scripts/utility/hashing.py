@@ -0,0 +1,90 @@
+"""
+hashing.py
+Streamed file hashing with a selectable hashlib algorithm, run across a worker pool
+"""
+import os
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+## md5 is the default so hashes match the ones already saved; blake2b is faster on 64-bit machines
+DEFAULT_ALGORITHM = 'md5'
+CHUNK_SIZE = 1024 * 1024
+
+def get_hasher(algorithm=DEFAULT_ALGORITHM):
+    """
+    new hashlib object for algorithm (e.g. 'md5', 'blake2b', 'sha256')
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError as error:
+        raise ValueError(f'Unsupported hash algorithm: {algorithm}') from error
+
+def file_hash(path, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE, use_mmap=False):
+    """
+    Generate a hash for a file, reading chunk_size bytes at a time
+    (or through mmap if use_mmap) so memory use does not grow with the file
+    """
+    hasher = get_hasher(algorithm)
+    with open(path, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, len(mapped), chunk_size):
+                    hasher.update(mapped[start:start + chunk_size])
+        else:
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                hasher.update(view[:length])
+    return hasher.hexdigest()
+
+def partial_file_hash(path, size=None, block_size=65536, algorithm=DEFAULT_ALGORITHM):
+    """
+    Hash of the first and last block_size bytes of a file (size is stat'ed if not given).
+    Returns (hash, is_full); if the file is no larger than two blocks the whole
+    file was read in order, so the hash equals file_hash(path).
+    """
+    hasher = get_hasher(algorithm)
+    with open(path, 'rb') as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        hasher.update(f.read(block_size))
+        if size > 2 * block_size:
+            f.seek(-block_size, os.SEEK_END)
+        hasher.update(f.read(block_size))
+    return hasher.hexdigest(), size <= 2 * block_size
+
+def get_executor(max_workers=None, use_processes=False):
+    """
+    thread pool by default: hashlib releases the GIL while hashing large chunks,
+    so threads keep every core and disk busy without pickling results between processes
+    """
+    if use_processes:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def hash_files(paths, func=file_hash, max_workers=None, use_processes=False, **kwargs):
+    """
+    {path: func(path, **kwargs)} for every path, hashed across a worker pool;
+    paths that cannot be read are left out. max_workers=1 hashes in this process.
+    """
+    paths = list(dict.fromkeys(paths))
+    hashes = {}
+    if max_workers == 1 or len(paths) <= 1:
+        for path in paths:
+            try:
+                hashes[path] = func(path, **kwargs)
+            except OSError as error:
+                print(f'Unable to hash {path}: {error}')
+        return hashes
+    with get_executor(max_workers, use_processes) as executor:
+        futures = {path: executor.submit(func, path, **kwargs) for path in paths}
+        for path, future in futures.items():
+            try:
+                hashes[path] = future.result()
+            except OSError as error:
+                print(f'Unable to hash {path}: {error}')
+    return hashes
@@ -3,6 +3,11 @@ id_validation.py
 validate IDs
 """
 import re
+from qc_scripts.utility.pattern import PatternSet, redcap_id_pattern_data
+
+IDTYPE_PATTERN = re.compile(r'^([A-Za-z]{2})(\d{1,2})$')
+NON_DIGITS = re.compile(r'[^0-9]')
+REDCAP_ID_PATTERN_SET = PatternSet(redcap_id_pattern_data())
 
 def get_pid(data, add_fid_idx='pid'):
     """
@@ -31,8 +36,7 @@ def validate_idtype(idtype):
     """
     check if idtype is valid, else raise assertion error;
     """
-    pattern = r'^([A-Za-z]{2})(\d{1,2})$'
-    match = re.fullmatch(pattern, idtype)
+    match = IDTYPE_PATTERN.fullmatch(idtype)
     if match:
         letters, digits = match.groups()
         digits = digits.zfill(2)
@@ -46,7 +50,7 @@ def validate_id(_id, remove_non_digits=True):
     check if id is valid, else raise assertion error;
     """
     if remove_non_digits:
-        _id = re.sub(r'[^0-9]', "", _id)
+        _id = NON_DIGITS.sub("", _id)
     length = len(_id)
     if length < 5:
         raise AssertionError(f"{_id} is < length 5;")
@@ -57,20 +61,10 @@ def validate_id(_id, remove_non_digits=True):
 def redcap_to_pid(redcap_id):
     """
     Convert to padded id and idtype. Do not allow the ID type to be '00
+    Tries the 5-digit ID pattern first, then the 4-digit ID pattern.
     """
-
-    match = re.fullmatch(r'^([A-Za-z]{2}\d{1,2})(\d{5})$', redcap_id)
-    if match:
-        id_type, _id = match.groups()
-        result = validate_idtype_and_id(id_type, _id)
-        if result is not None:
-            return result
-
-    # Try 4-digit ID
-    match = re.fullmatch(r'^([A-Za-z]{2}\d{1,2})(\d{4})$', redcap_id)
-    if match:
-        id_type, _id = match.groups()
-        result = validate_idtype_and_id(id_type, _id)
+    for _, value in REDCAP_ID_PATTERN_SET.search_all(redcap_id):
+        result = validate_idtype_and_id(value['idtype'], value['id'])
         if result is not None:
             return result
 
@@ -2,13 +2,18 @@
 move_file.py
 """
 import os
+import errno
 import shutil
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from collections import defaultdict
 from qc_scripts.utility.read import read_dictionary_file
 from qc_scripts.utility.yield_data import yield_data
 from qc_scripts.utility.log_helper import add_readables_to_kwargs
+from qc_scripts.utility.hashing import get_hasher, file_hash, DEFAULT_ALGORITHM, CHUNK_SIZE
 
 def shutil_move(src, dst, **kwargs):
     src_exists = os.path.isfile(src)
@@ -21,6 +26,358 @@ def shutil_move(src, dst, **kwargs):
     status = gen_status(src_exists, dst_exists)
     return status, src_exists, dst_exists
 
+## parent folders already made by native_move in this process
+MADE_DIRS = set()
+
+def make_parent(dst, made_dirs=MADE_DIRS):
+    """
+    makedirs for the parent of dst, once per folder
+    """
+    parent = os.path.dirname(dst)
+    if parent != '' and parent not in made_dirs:
+        os.makedirs(parent, exist_ok=True)
+        made_dirs.add(parent)
+
+## renameat2(2): fail with EEXIST instead of replacing dst; AT_FDCWD resolves paths
+## from the working directory like rename(2)
+RENAME_NOREPLACE = 1
+AT_FDCWD = -100
+RENAMEAT2 = []
+
+def get_renameat2():
+    """
+    libc's renameat2 (Linux, glibc 2.28+), or None where there is none
+    """
+    if len(RENAMEAT2) == 0:
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            RENAMEAT2.append((ctypes, libc.renameat2))
+        except (ImportError, OSError, AttributeError):
+            RENAMEAT2.append(None)
+    return RENAMEAT2[0]
+
+def rename_no_replace(src, dst):
+    """
+    rename src to dst, raising FileExistsError if dst exists instead of replacing it:
+    renameat2 with RENAME_NOREPLACE on Linux, os.rename on Windows (which never
+    replaces), else a hardlink to dst then unlinking src
+    """
+    if os.name == 'nt':
+        os.rename(src, dst)
+        return
+    renameat2 = get_renameat2()
+    if renameat2 is not None:
+        ctypes, func = renameat2
+        if func(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+        error = ctypes.get_errno()
+        ## EINVAL where the filesystem does not support the flag, ENOSYS on old kernels
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(error, os.strerror(error), src, None, dst)
+    try:
+        os.link(src, dst)
+    except OSError as error:
+        ## filesystems without hardlinks: the check and the rename are not atomic here
+        if error.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK):
+            raise
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+        os.rename(src, dst)
+        return
+    os.unlink(src)
+
+def partial_file(dst):
+    """
+    a new empty temporary file next to dst, not shared with any other copy to dst
+    """
+    fd, tmp = tempfile.mkstemp(prefix=f'{os.path.basename(dst)}.', suffix='.partial',
+                               dir=os.path.dirname(dst) or '.')
+    os.close(fd)
+    return tmp
+
+def stream_copy(src, dst):
+    """
+    copy src to a temporary file next to dst and rename it into place,
+    so dst is never left half written and an existing dst is never replaced
+    """
+    tmp = partial_file(dst)
+    try:
+        shutil.copyfile(src, tmp) ## streamed; uses sendfile where the OS has it
+        shutil.copystat(src, tmp)
+        rename_no_replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def rename_or_copy(src, dst):
+    """
+    rename_no_replace() on the same device; a streamed copy then unlinking src
+    across devices
+    """
+    try:
+        rename_no_replace(src, dst)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        stream_copy(src, dst)
+        os.unlink(src)
+
+def error_status(src, dst, error):
+    """
+    (status, src_exists, dst_exists, error) after a move raised error; a dst that was
+    made by another move since it was checked is left as it is and reported as
+    (status, src_exists, True) without an error
+    """
+    src_exists, dst_exists = os.path.isfile(src), os.path.isfile(dst)
+    if isinstance(error, FileExistsError) and os.path.lexists(dst):
+        return gen_status(src_exists, True), src_exists, True
+    return gen_status(src_exists, dst_exists), src_exists, dst_exists, f'{type(error).__name__}: {error}'
+
+def src_dst_exist(src, dst, checked=False):
+    """
+    (src_exists, dst_exists) before a move; if checked (by plan_moves), they are
+    taken as (True, False) without a stat, and a dst made since is still found by
+    the no-replace rename
+    """
+    if checked:
+        return True, False
+    return os.path.isfile(src), os.path.lexists(dst)
+
+def native_move(src, dst, **kwargs):
+    """
+    move in this process, without a subprocess per file;
+    an existing dst is never overwritten, even one made by another move after it was
+    checked. Errors are returned with the status (status, src_exists, dst_exists, error)
+    instead of being raised.
+    """
+    made_dirs = kwargs.get('made_dirs', MADE_DIRS)
+    src_exists, dst_exists = src_dst_exist(src, dst, kwargs.get('checked', False))
+    if not src_exists or dst_exists:
+        return gen_status(src_exists, dst_exists), src_exists, dst_exists
+    try:
+        make_parent(dst, made_dirs)
+        try:
+            rename_or_copy(src, dst)
+        except FileNotFoundError:
+            ## the parent may have been removed since it was made
+            made_dirs.discard(os.path.dirname(dst))
+            make_parent(dst, made_dirs)
+            rename_or_copy(src, dst)
+    except OSError as error:
+        return error_status(src, dst, error)
+    return gen_status(False, True), False, True
+
+def kernel_copy(fsrc, fdst, size):
+    """
+    copy size bytes between two open files without reading them into this process
+    (os.copy_file_range, else os.sendfile); False if the kernel cannot for these files
+    """
+    copied = 0
+    try:
+        while copied < size:
+            if hasattr(os, 'copy_file_range'):
+                n_bytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+            elif hasattr(os, 'sendfile'):
+                n_bytes = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+            else:
+                return False
+            if n_bytes == 0:
+                break
+            copied += n_bytes
+    except OSError as error:
+        ## e.g. an old kernel, or filesystems copy_file_range does not support
+        if copied == 0 and error.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                                           errno.EOPNOTSUPP, errno.ENOTSUP):
+            return False
+        raise
+    if copied != size:
+        raise OSError(errno.EIO, f'copied {copied} of {size} bytes')
+    return True
+
+def hashing_copy(fsrc, fdst, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE):
+    """
+    copy between two open files, hashing each chunk as it is written; returns the hash
+    """
+    hasher = get_hasher(algorithm)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        length = fsrc.readinto(buffer)
+        if not length:
+            break
+        hasher.update(view[:length])
+        fdst.write(view[:length])
+    return hasher.hexdigest()
+
+def checksum_copy(src, dst, **kwargs):
+    """
+    copy src to dst and return the content hash of the copy:
+    (status, src_exists, dst_exists, {'checksum', 'checksum_algorithm'}).
+    With zero_copy (default) the kernel copies the bytes and the copy is then hashed
+    (usually from the page cache), which also checks what was written; without it, or
+    where the kernel cannot, the hash is computed in the same pass that writes the copy.
+    An existing dst is never overwritten; errors are returned like native_move().
+    """
+    algorithm = kwargs.get('algorithm', DEFAULT_ALGORITHM)
+    zero_copy = kwargs.get('zero_copy', True)
+    made_dirs = kwargs.get('made_dirs', MADE_DIRS)
+    src_exists, dst_exists = src_dst_exist(src, dst, kwargs.get('checked', False))
+    if not src_exists or dst_exists:
+        return gen_status(src_exists, dst_exists), src_exists, dst_exists
+    try:
+        make_parent(dst, made_dirs)
+        tmp = partial_file(dst)
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                if zero_copy and kernel_copy(fsrc, fdst, size):
+                    checksum = None
+                else:
+                    checksum = hashing_copy(fsrc, fdst, algorithm)
+            if checksum is None:
+                checksum = file_hash(tmp, algorithm)
+            shutil.copystat(src, tmp)
+            rename_no_replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    except OSError as error:
+        return error_status(src, dst, error)
+    return gen_status(True, True), True, True, {'checksum': checksum, 'checksum_algorithm': algorithm}
+
+## ioctl(2) request for a reflink (FICLONE, see ioctl_ficlone(2)); Linux btrfs, xfs, ...
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """
+    make dst a copy-on-write clone of src; False if the OS or filesystem cannot
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+    if not cloned:
+        os.remove(dst)
+    return cloned
+
+def link_copy(src, dst, **kwargs):
+    """
+    stage src at dst without moving it: a hardlink (link='hardlink', default) or a
+    reflink (link='reflink'), so only metadata is written; falls back to a reflink,
+    then a streamed copy, where the link cannot be made (e.g. across devices).
+    Returns (status, src_exists, dst_exists, {'link': 'hardlink', 'reflink' or 'copy'});
+    an existing dst is never overwritten and errors are returned like native_move().
+    """
+    link = kwargs.get('link', 'hardlink')
+    made_dirs = kwargs.get('made_dirs', MADE_DIRS)
+    src_exists, dst_exists = src_dst_exist(src, dst, kwargs.get('checked', False))
+    if not src_exists or dst_exists:
+        return gen_status(src_exists, dst_exists), src_exists, dst_exists
+    try:
+        make_parent(dst, made_dirs)
+        made = None
+        if link == 'hardlink':
+            try:
+                os.link(src, dst)
+                made = 'hardlink'
+            except OSError as error:
+                ## EXDEV across devices; EPERM/ENOTSUP/EMLINK where links are not allowed
+                if error.errno == errno.EEXIST:
+                    raise
+        if made is None and reflink(src, dst):
+            made = 'reflink'
+        if made is None:
+            stream_copy(src, dst)
+            made = 'copy'
+    except OSError as error:
+        return error_status(src, dst, error)
+    return gen_status(True, True), True, True, {'link': made}
+
+def device_of(path):
+    """
+    st_dev of path, or of its closest existing parent (dst folders may not exist yet);
+    None if it cannot be found
+    """
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+class DeviceLimiter:
+    """
+    One semaphore per filesystem, so no more than per_device moves read from or write
+    to the same device at a time. The source and destination devices of a move are
+    always acquired in the same order, so two moves cannot wait on each other.
+    """
+    def __init__(self, per_device=4):
+        self.per_device = per_device
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f'DeviceLimiter(per_device={self.per_device})'
+
+    def semaphore(self, device):
+        """
+        the semaphore of a device
+        """
+        with self.lock:
+            if device not in self.semaphores:
+                self.semaphores[device] = threading.BoundedSemaphore(self.per_device)
+            return self.semaphores[device]
+
+    def run(self, devices, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) while holding the semaphores of devices
+        """
+        semaphores = [self.semaphore(device) for device in sorted(set(devices), key=str)]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+def concurrent_moves(jobs, move_function=None, max_workers=8, per_device=4, **kwargs):
+    """
+    runs move_function(src, dst, **kwargs) for every (src, dst) in jobs on a thread pool,
+    with at most per_device moves per source or destination filesystem at a time.
+    Returns the results in the order of jobs. max_workers=1 moves one at a time in order.
+    """
+    move_function = move_function or native_move
+    if max_workers == 1:
+        return [move_function(src, dst, **kwargs) for src, dst in tqdm(jobs)]
+    limiter = DeviceLimiter(per_device)
+    devices = {} ## parent folder -> device
+    def parent_device(path):
+        parent = None if path is None else os.path.dirname(os.path.abspath(path))
+        if parent not in devices:
+            devices[parent] = device_of(parent)
+        return devices[parent]
+    def move(src, dst):
+        return limiter.run([parent_device(src), parent_device(dst)], move_function, src, dst, **kwargs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(move, src, dst) for src, dst in jobs]
+        return [future.result() for future in tqdm(futures)]
+
 def linux_copy(src, dst, **kwargs):
     """
     copy using cp;
@@ -81,12 +438,11 @@ def subprocess_copy(src, dst, command, **kwargs):
             process.communicate() ## returns std_out_data, std_err_data;
     src_exists = check_exists(src)
     dst_exists = check_exists(dst)
-    if not dst_exists:
-        print('dst does not exist still!!!!!!!!')
-        input()
     status = gen_status(src_exists, dst_exists)
     if not return_src_dst_exist:
         return status
+    if not dst_exists:
+        return status, src_exists, dst_exists, f'dst does not exist after: {command}'
     return status, src_exists, dst_exists
 
 def gen_status(src_exists, dst_exists):
@@ -110,15 +466,20 @@ def kv_status_src_dst_exist(*args):
     parameters:
         args(list):
             args -> key, data, status
-        status(tuple): status, src_exists, dst_exists
+        status(tuple): status, src_exists, dst_exists (, error or dictionary of extra fields)
     """
     key, data, status = args
     try:
-        status, src_exists, dst_exists = status
+        status, src_exists, dst_exists, *extra = status
     except ValueError as error:
         print(status)
         raise error
     data.update({'status': status, 'src_exists': src_exists, 'dst_exists': dst_exists})
+    for value in extra:
+        if isinstance(value, dict):
+            data.update(value)
+        else:
+            data['move_error'] = value
     return key, data
 
 def move_data(data_json, **kwargs):
@@ -151,6 +512,10 @@ def move_data(data_json, **kwargs):
                 multiple_values for a given key in the final dictionary
 
             ext(str): string extension to the save name of the json file
+
+            max_workers(int): number of move threads; 1 moves one file at a time
+
+            per_device(int): most moves reading from or writing to one filesystem at a time
     """
     read_data_file = kwargs.get('read_data_file', read_dictionary_file)
     read_data_file_kw = kwargs.get('read_data_file_kw', {})
@@ -186,6 +551,8 @@ def move_data(data_json, **kwargs):
     multiple_values = kwargs.get("multiple_values", True)
     ext = kwargs.get("ext", "")
     debug = kwargs.get('debug', False)
+    max_workers = kwargs.get('max_workers', 8)
+    per_device = kwargs.get('per_device', 4)
 
 
     for kwarg in [get_src_dst_kw]:
@@ -194,7 +561,8 @@ def move_data(data_json, **kwargs):
 
     folder_list_idx = 0
     final = {} if not multiple_values else defaultdict(list)
-    for key, value in tqdm(read_data_file(data_json, **read_data_file_kw).items()):
+    jobs = []
+    for key, value in read_data_file(data_json, **read_data_file_kw).items():
         for item in data_iterator(value):
             if count is not None and count == limit:
                 count = 0
@@ -211,22 +579,27 @@ def move_data(data_json, **kwargs):
                 data = dict(data)
                 if count is not None:
                     count += 1
-                status = move_function(src, dst, **move_function_kw)
-
-                if make_kv is None:
-                    new_key = make_key(key, **make_key_kw)
-                    new_value = make_value(key, new_key, status, data, **make_value_kw)
-                else:
-                    new_key, new_value = make_kv(key, data, status, **make_kv_kw)
-
-                if add_src_and_dst_to_data:
-                    new_value.update({src_key: src, dst_key: dst})
-
-                if multiple_values:
-                    final[new_key].append(new_value)
-                else:
-                    assert new_key not in final, f"{new_key}, {new_value}"
-                    final[new_key] = new_value
-                if debug:
-                    print(dst)
+                jobs.append((key, src, dst, data))
+
+    statuses = concurrent_moves([(src, dst) for _, src, dst, _ in jobs], move_function,
+                                max_workers=max_workers, per_device=per_device, **move_function_kw)
+
+    ## results are in the order of the input, however the moves finished
+    for (key, src, dst, data), status in zip(jobs, statuses):
+        if make_kv is None:
+            new_key = make_key(key, **make_key_kw)
+            new_value = make_value(key, new_key, status, data, **make_value_kw)
+        else:
+            new_key, new_value = make_kv(key, data, status, **make_kv_kw)
+
+        if add_src_and_dst_to_data:
+            new_value.update({src_key: src, dst_key: dst})
+
+        if multiple_values:
+            final[new_key].append(new_value)
+        else:
+            assert new_key not in final, f"{new_key}, {new_value}"
+            final[new_key] = new_value
+        if debug:
+            print(dst)
     return {'final': final, '_ext': ext}
\ No newline at end of file
@@ -0,0 +1,189 @@
+"""
+move_journal.py
+Append-only journal of planned and completed moves, so an interrupted move can be
+resumed and a finished one rolled back without going over every file again
+"""
+import os
+import json
+import threading
+from datetime import datetime
+from collections import defaultdict
+from qc_scripts.utility.move_commands import native_move, kv_status_src_dst_exist, gen_status
+
+class MoveJournal:
+    """
+    Newline-delimited JSON records:
+        {'op': 'intent', 'key', 'src', 'dst'} written (and fsynced) before any file is moved
+        {'op': 'done', 'src', 'dst', 'moved', 'copied', 'result'} once a move has finished;
+            moved if src is now at dst, copied if a copy or link of src was made at dst
+        {'op': 'rolled_back', 'src', 'dst', 'result'} once a move or copy has been undone
+        {'op': 'finished'} once every planned move is done
+    Records are fsynced every batch_size writes; a crash loses at most the last batch
+    of 'done' records, and those moves are found already done when the run resumes.
+    """
+    def __init__(self, path, batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.unsynced = 0
+
+    def __repr__(self):
+        return f'MoveJournal({self.path!r})'
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *_):
+        self.close()
+
+    def records(self):
+        """
+        yields the records written so far; a torn last line (from a crash) is skipped
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def state(self):
+        """
+        (intents, done, rolled_back, finished): intents {(src, dst): key},
+        done {(src, dst): latest record} in the order the moves last finished,
+        rolled_back {(src, dst)} of the moves undone since their last 'done' record,
+        and whether the journal was finished
+        """
+        intents, done, rolled_back, finished = {}, {}, set(), False
+        for record in self.records():
+            pair = (record.get('src'), record.get('dst'))
+            if record['op'] == 'intent':
+                intents[pair] = record.get('key')
+            elif record['op'] == 'done':
+                ## a move retried after it failed keeps the order of its last attempt
+                done.pop(pair, None)
+                done[pair] = record
+                ## a move made again after a rollback can be rolled back again
+                rolled_back.discard(pair)
+            elif record['op'] == 'rolled_back':
+                rolled_back.add(pair)
+            elif record['op'] == 'finished':
+                finished = True
+        return intents, done, rolled_back, finished
+
+    def archive(self):
+        """
+        renames a finished journal out of the way so a new run starts a new one
+        """
+        if os.path.isfile(self.path):
+            os.replace(self.path, f"{self.path}.{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+
+    def open(self):
+        """
+        open for appending
+        """
+        parent = os.path.dirname(self.path)
+        if parent != '':
+            os.makedirs(parent, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def sync(self):
+        """
+        flush and fsync the records written so far
+        """
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def write(self, records, sync=False):
+        """
+        append records; fsynced once batch_size records are waiting, or now if sync
+        """
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record))
+                self.file.write('\n')
+                self.unsynced += 1
+            if sync or self.unsynced >= self.batch_size:
+                self._sync()
+
+    def close(self):
+        """
+        fsync and close
+        """
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+def move_succeeded(status):
+    """
+    True if a move_function status says src is now at dst
+    """
+    return len(status) == 3 and status[0] == 'only_dst_exists'
+
+def copy_succeeded(status):
+    """
+    True if a move_function status says src was copied or linked to dst and left where
+    it was (checksum_copy, link_copy)
+    """
+    return len(status) == 4 and status[0] == 'both_exist' and isinstance(status[3], dict) \
+        and ('checksum' in status[3] or 'link' in status[3])
+
+def is_done(record):
+    """
+    True if a 'done' record needs no retry: the file was moved or copied
+    """
+    return bool(record.get('moved') or record.get('copied'))
+
+def remove_copy(src, dst):
+    """
+    undo a copy or link: remove dst, only while src is still there; returns the status
+    of moving dst back to src, like the rolled back moves
+    """
+    if not os.path.isfile(src):
+        return gen_status(os.path.isfile(dst), False), os.path.isfile(dst), False, \
+            'src is missing; dst kept'
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        return gen_status(os.path.isfile(dst), True), os.path.isfile(dst), True, \
+            f'{type(error).__name__}: {error}'
+    return gen_status(False, True), False, True
+
+def rollback_journal(**kwargs):
+    """
+    SourceNode function; moves the completed moves of a journal back, newest first,
+    and removes the copies and links a staged or copying run made (while their src is
+    still there). Only the moves the journal recorded as done are touched, so the work
+    depends on how far the run got, not on how many files it planned to move.
+    """
+    journal = MoveJournal(kwargs.get('journal'), kwargs.get('batch_size', 100))
+    move_function = kwargs.get('move_function', native_move)
+    ext = kwargs.get('ext', 'rollback')
+
+    intents, done, rolled_back, _ = journal.state()
+    final = defaultdict(list)
+    with journal:
+        for (src, dst), record in reversed(list(done.items())):
+            if not is_done(record) or (src, dst) in rolled_back:
+                continue
+            if record.get('moved'):
+                status = move_function(dst, src)
+            else:
+                status = remove_copy(src, dst)
+            journal.write([{'op': 'rolled_back', 'src': src, 'dst': dst, 'result': status}])
+            key, value = kv_status_src_dst_exist(intents.get((src, dst)), {'src': dst, 'dst': src},
+                                                 status)
+            final[key].append(value)
+    return [{'final': final, 'ext': ext}]
@@ -0,0 +1,161 @@
+"""
+move_plan.py
+Plans a batch of moves before any file is moved: finds destinations claimed by more
+than one source and files already in place with one listing per folder, and makes
+the destination folders once
+"""
+import os
+import tempfile
+from collections import defaultdict
+from qc_scripts.utility.move_commands import MADE_DIRS, gen_status
+
+class MovePlan:
+    """
+    moves: (src, dst) pairs that can run without checking src or dst again
+    skipped: {(src, dst): status} for pairs that were resolved while planning
+    collisions: {dst: [src, ...]} for destinations claimed by more than one source
+    dirs: destination folders made for the moves
+    """
+    def __init__(self, moves, skipped, collisions, dirs):
+        self.moves = moves
+        self.skipped = skipped
+        self.collisions = collisions
+        self.dirs = dirs
+
+    def __repr__(self):
+        return (f'MovePlan({len(self.moves)} moves, {len(self.skipped)} skipped, '
+                f'{len(self.collisions)} collisions, {len(self.dirs)} folders)')
+
+    def as_dict(self):
+        """
+        JSON-friendly plan (k=dst for collisions)
+        """
+        return {'moves': [{'src': src, 'dst': dst} for src, dst in self.moves],
+                'skipped': [{'src': src, 'dst': dst, 'status': status[0]}
+                            for (src, dst), status in self.skipped.items()],
+                'collisions': self.collisions,
+                'dirs': self.dirs}
+
+## st_dev -> True if the filesystem matches names without case
+CASE_INSENSITIVE = {}
+
+def existing_folder(path):
+    """
+    path if it is a folder, else its closest existing parent folder
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def case_insensitive(folder):
+    """
+    True if names in folder (or its closest existing parent) are matched without case,
+    e.g. on macOS APFS/HFS+ or Windows NTFS; probed once per device with a temporary file
+    """
+    folder = existing_folder(folder or '.')
+    device = os.stat(folder).st_dev
+    if device not in CASE_INSENSITIVE:
+        try:
+            fd, probe = tempfile.mkstemp(prefix='.case_probe_', dir=folder)
+            os.close(fd)
+            try:
+                CASE_INSENSITIVE[device] = os.path.exists(
+                    os.path.join(folder, os.path.basename(probe).upper()))
+            finally:
+                os.remove(probe)
+        except OSError:
+            ## e.g. a read-only folder; assume the platform default
+            CASE_INSENSITIVE[device] = os.path.normcase('A') == 'a'
+    return CASE_INSENSITIVE[device]
+
+def folder_case(folders=None):
+    """
+    fold_case(folder) for list_dirs() and exists_in(): case_insensitive() memoized per folder
+    """
+    folders = {} if folders is None else folders
+    def fold_case(folder):
+        if folder not in folders:
+            folders[folder] = case_insensitive(folder)
+        return folders[folder]
+    return fold_case
+
+def list_dirs(paths, files_only=False, fold_case=None):
+    """
+    {folder: set of names} for the folders of paths, listing each folder once;
+    a folder that does not exist has no names. Names are casefolded in the folders
+    where fold_case(folder) is True.
+    """
+    listings = {}
+    for path in paths:
+        parent = os.path.dirname(path)
+        if parent in listings:
+            continue
+        try:
+            with os.scandir(parent or '.') as entries:
+                listings[parent] = {entry.name for entry in entries
+                                    if not files_only or entry.is_file()}
+            if fold_case is not None and fold_case(parent):
+                listings[parent] = {name.casefold() for name in listings[parent]}
+        except (FileNotFoundError, NotADirectoryError):
+            listings[parent] = set()
+    return listings
+
+def exists_in(listings, path, fold_case=None):
+    """
+    True if path is in the listing of its folder (from list_dirs() with the same fold_case)
+    """
+    parent, name = os.path.split(path)
+    if fold_case is not None and fold_case(parent):
+        name = name.casefold()
+    return name in listings[parent]
+
+def dst_key(dst, fold_case=None):
+    """
+    key of a destination: two dsts with the same key are the same file
+    """
+    key = os.path.normcase(os.path.normpath(dst))
+    if fold_case is not None and fold_case(os.path.dirname(dst)):
+        key = key.casefold()
+    return key
+
+def plan_moves(pairs, make_dirs=True, made_dirs=MADE_DIRS):
+    """
+    Resolves a batch of (src, dst) pairs before anything is moved.
+    A dst claimed by more than one src is a collision and none of its moves are run;
+    pairs whose src is missing or whose dst already exists are skipped with the status
+    a move_function would have returned. Names are compared without case on filesystems
+    that match them without case (x.wav and X.WAV are then the same dst).
+    With make_dirs, the folders of the remaining destinations are made once and added
+    to made_dirs.
+    """
+    pairs = list(dict.fromkeys(pair for pair in pairs if pair[0] is not None))
+    fold_case = folder_case()
+    srcs_by_dst = defaultdict(list)
+    for src, dst in pairs:
+        srcs_by_dst[dst_key(dst, fold_case)].append(src)
+    collisions = {dst: srcs for dst, srcs in srcs_by_dst.items() if len(srcs) > 1}
+
+    src_listings = list_dirs([src for src, _ in pairs], files_only=True, fold_case=fold_case)
+    dst_listings = list_dirs([dst for _, dst in pairs], fold_case=fold_case)
+
+    moves, skipped = [], {}
+    for src, dst in pairs:
+        src_exists = exists_in(src_listings, src, fold_case)
+        dst_exists = exists_in(dst_listings, dst, fold_case)
+        others = collisions.get(dst_key(dst, fold_case))
+        if others is not None:
+            skipped[(src, dst)] = (gen_status(src_exists, dst_exists), src_exists, dst_exists,
+                                   f"dst_collision: {', '.join(s for s in others if s != src)}")
+        elif not src_exists or dst_exists:
+            skipped[(src, dst)] = (gen_status(src_exists, dst_exists), src_exists, dst_exists)
+        else:
+            moves.append((src, dst))
+
+    dirs = sorted({os.path.dirname(dst) for _, dst in moves} - {''})
+    if make_dirs:
+        for parent in dirs:
+            if parent not in made_dirs:
+                os.makedirs(parent, exist_ok=True)
+                made_dirs.add(parent)
+    return MovePlan(moves, skipped, collisions, dirs)
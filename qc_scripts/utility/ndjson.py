@@ -0,0 +1,110 @@
+"""
+ndjson.py
+methods for streaming dictionaries to and from newline-delimited JSON files;
+each line holds a single {key: value} pair
+"""
+import os
+import json
+import heapq
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+class NDJSONFile:
+    """
+    Points to a newline-delimited JSON file written by write_grouped_ndjson.
+    Used as a pipeline output in place of a dictionary; the logger moves the
+    file into the save_log folder instead of dumping it.
+    """
+    def __init__(self, path, n_keys=0, n_values=0):
+        self.path = path
+        self.n_keys = n_keys
+        self.n_values = n_values
+
+    def __len__(self):
+        return self.n_keys
+
+    def __repr__(self):
+        return f'NDJSONFile({self.path!r})'
+
+    def items(self):
+        """
+        yields (key, value) one line at a time
+        """
+        return yield_ndjson(self.path)
+
+def yield_ndjson(filename):
+    """
+    yields (key, value) for each line of an ndjson dictionary file
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            yield from json.loads(line).items()
+
+def write_ndjson_line(f, key, value, **kwargs):
+    """
+    write one {key: value} line
+    """
+    f.write(json.dumps({key: value}, **kwargs))
+    f.write('\n')
+
+def spill_chunk(chunk, tmp_dir):
+    """
+    sort a chunk of (key, value) pairs by key and write them to a temporary file;
+    sorted() is stable, so values keep their original order within a key
+    """
+    chunk.sort(key=itemgetter(0))
+    fd, tmp_path = tempfile.mkstemp(suffix='.ndjson', dir=tmp_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for key, value in chunk:
+            f.write(json.dumps([key, value]))
+            f.write('\n')
+    return tmp_path
+
+def yield_chunk(tmp_path):
+    """
+    read back a spilled chunk
+    """
+    with open(tmp_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            key, value = json.loads(line)
+            yield key, value
+
+def write_grouped_ndjson(pairs, path, chunk_size=100000, multiple_values=True, **kwargs):
+    """
+    Writes (key, value) pairs to path with one {key: [values]} line per key.
+    Pairs are sorted by key in chunks of chunk_size, spilled to temporary files
+    and merged, so memory holds at most one chunk and one group at a time.
+    Values keep the order they were given in within each key.
+    If multiple_values is False, each key may only have one value and it is
+    written without the list.
+    """
+    tmp_dir = os.path.dirname(os.path.abspath(path))
+    spilled = []
+    chunk = []
+    try:
+        for pair in pairs:
+            chunk.append(pair)
+            if len(chunk) >= chunk_size:
+                spilled.append(spill_chunk(chunk, tmp_dir))
+                chunk = []
+        chunk.sort(key=itemgetter(0))
+        ## heapq.merge is stable, so earlier chunks come first within a key
+        merged = heapq.merge(*[yield_chunk(p) for p in spilled], iter(chunk), key=itemgetter(0))
+        n_keys, n_values = 0, 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, group in groupby(merged, key=itemgetter(0)):
+                values = [value for _, value in group]
+                if not multiple_values:
+                    assert len(values) == 1, key
+                    values = values[0]
+                else:
+                    n_values += len(values)
+                write_ndjson_line(f, key, values, **kwargs)
+                n_keys += 1
+    finally:
+        for tmp_path in spilled:
+            os.remove(tmp_path)
+    return NDJSONFile(path, n_keys, n_values if multiple_values else None)
@@ -2,6 +2,12 @@
 pattern.py
 Holds scripts defining patterns 
 """
+import re
+
+GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+## group references (\1, (?(1)...), (?P=name)); numbered ones would point at other
+## groups once the patterns are combined, so patterns with any of them are not combined
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
 
 def example_pattern_data(): 
     """
@@ -13,4 +19,112 @@ def example_pattern_data():
     """
     pattern = r'([A-Za-z]{2}\d{1,2})_(\d{4,5})_(\d{8})_(\d{3,4})_(remote|in-person)'
     indices = [(0, 'idtype'), (1, 'id'), (2, 'date'), (3, 'tester_id'), (4, 'location')]
-    return [(pattern, indices)]
\ No newline at end of file
+    return [(pattern, indices)]
+
+def destination_pattern_data():
+    """
+    pattern used to standardize destination filenames;
+    the ID type letters and numbers are split so they can be padded separately
+    """
+    pattern = r'([A-Za-z]{2})(\d{1,2})_(\d{4,5})_(\d{8})_(\d{3,4})_(remote|in-person)'
+    indices = [(0, 'idtype_letters'), (1, 'idtype_digits'), (2, 'id'), (3, 'date'),
+               (4, 'tester_id'), (5, 'location')]
+    return [(pattern, indices)]
+
+def redcap_id_pattern_data():
+    """
+    REDCap record ids: ID type followed by a 5 digit ID, else a 4 digit ID
+    """
+    indices = [(0, 'idtype'), (1, 'id')]
+    return [(r'^([A-Za-z]{2}\d{1,2})(\d{5})$', indices),
+            (r'^([A-Za-z]{2}\d{1,2})(\d{4})$', indices)]
+
+def scope_flags(pattern):
+    """
+    turn leading global inline flags, e.g. (?i), into a scoped group
+    so the pattern can be embedded in a larger regex
+    """
+    match = GLOBAL_FLAGS.match(pattern)
+    if match is None:
+        return pattern
+    return f'(?{match.group(1)}:{pattern[match.end():]})'
+
+class PatternSet:
+    """
+    A list of (pattern, indices) compiled once.
+    Where they can be, the patterns are combined into a single regex: each pattern is
+    wrapped in a named group inside a lookahead, so one match call (in C, rather than a
+    Python loop) returns the first pattern in list order found in the string and its
+    fields. Each lookahead still scans the string for its own pattern. Patterns that
+    refer to their own groups, or whose group names clash, are searched one at a time
+    (combined is None), which gives the same results.
+    """
+    def __init__(self, pattern_list, flags=0):
+        self.pattern_list = [(pattern, list(indices)) for pattern, indices in pattern_list]
+        self.flags = flags
+        self.compiled = [re.compile(pattern, flags) for pattern, _ in self.pattern_list]
+        self.combined = self.combine()
+        ## group number of the first group within each pattern
+        self.offsets = [] if self.combined is None else \
+            [self.combined.groupindex[f'p{i}'] + 1 for i in range(len(self.pattern_list))]
+
+    def __repr__(self):
+        return f'PatternSet({self.pattern_list!r}, flags={int(self.flags)})'
+
+    def __len__(self):
+        return len(self.pattern_list)
+
+    def combine(self):
+        """
+        the patterns as one regex, or None if they cannot be combined
+        """
+        if any(GROUP_REFERENCE.search(pattern) for pattern, _ in self.pattern_list):
+            return None
+        alternation = '|'.join(f'(?=(?s:.)*?(?P<p{i}>{scope_flags(pattern)}))'
+                               for i, (pattern, _) in enumerate(self.pattern_list))
+        try:
+            combined = re.compile(f'(?:{alternation})', self.flags)
+        except re.error:
+            ## e.g. the same group name in two patterns
+            return None
+        if any(combined.groupindex.get(f'p{i}') is None for i in range(len(self.pattern_list))):
+            return None
+        return combined
+
+    def get_value(self, index, groups):
+        """
+        build the {key: group} dictionary for the pattern at index
+        """
+        return {key: groups[idx] for idx, key in self.pattern_list[index][1]}
+
+    def search(self, string):
+        """
+        returns the index of the first matching pattern and its extracted fields;
+        (None, {}) if no pattern matches
+        """
+        if self.combined is None:
+            return next(self.search_all(string), (None, {}))
+        match = self.combined.match(string)
+        if match is None:
+            return None, {}
+        index = int(match.lastgroup[1:])
+        offset = self.offsets[index]
+        groups = match.groups()[offset - 1:offset - 1 + self.compiled[index].groups]
+        return index, self.get_value(index, groups)
+
+    def search_all(self, string):
+        """
+        yields (index, fields) for every matching pattern, in list order
+        """
+        for index, compiled in enumerate(self.compiled):
+            match = compiled.search(string)
+            if match is not None:
+                yield index, self.get_value(index, match.groups())
+
+def as_pattern_set(pattern_data, flags=0):
+    """
+    compile pattern data into a PatternSet unless it already is one
+    """
+    if isinstance(pattern_data, PatternSet):
+        return pattern_data
+    return PatternSet(pattern_data, flags)
@@ -6,6 +6,7 @@ import os
 import csv
 import json
 from collections import defaultdict
+from qc_scripts.utility.ndjson import yield_ndjson
 
 def json_load(filename):
      """
@@ -43,8 +44,10 @@ def read_dictionary_file(filename, **kwargs):
         except json.decoder.JSONDecodeError as error:
             print(f'filename: {filename}\n\n')
             raise error
+    elif ext == '.ndjson':
+        data = dict(yield_ndjson(filename))
     else:
-        raise TypeError('{} is not of ext .txt or .json, cannot read'.format(filename))
+        raise TypeError('{} is not of ext .txt, .json or .ndjson, cannot read'.format(filename))
     if stop_after is None:
         return data
     new_data = {}
@@ -52,4 +55,17 @@ def read_dictionary_file(filename, **kwargs):
         if idx >= stop_after:
             return new_data
         new_data[key] = data[key]
-    return new_data
\ No newline at end of file
+    return new_data
+
+def dictionary_items(data, **kwargs):
+    """
+    get the (key, value) pairs of a dictionary or a dictionary file;
+    .ndjson files are read one line at a time instead of all at once.
+    Only the reading is lazy: a node that keeps what it reads (e.g. in its outputs)
+    still holds it in memory.
+    """
+    if isinstance(data, str) and os.path.splitext(data)[1] == '.ndjson':
+        return yield_ndjson(data)
+    if isinstance(data, str):
+        data = read_dictionary_file(data, **kwargs)
+    return data.items()
@@ -2,11 +2,16 @@
 walk.py: Abstracted walk for all QCs
 """
 import os
-import re
+import json
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from qc_scripts.utility.dates import get_date_string
 from qc_scripts.utility.id_validation import get_pid
 from qc_scripts.utility.errors import on_error
+from qc_scripts.utility.ndjson import write_grouped_ndjson
+from qc_scripts.utility.pattern import as_pattern_set
+from qc_scripts.utility.read import read_dictionary_file
 
 def default_make_kv(__, data, **_):
     """
@@ -41,23 +46,119 @@ def match_filename_format(_, data, **kwargs):
 def match_pattern_data(string, pattern_data):
     """
     find pattern data match;
+    pattern_data may be a PatternSet or a list of (pattern, indices)
     """
-    value = {}
-    pattern_data = [(re.compile(p), i) for p, i in pattern_data]
-    for compiled, indices in pattern_data:
-        search = compiled.search(string)
-        if search is None:
-            continue
-        groups = search.groups()
-        for idx, key in indices:
-            value[key] = groups[idx]
-        ## stop once we match one pattern
-        return value
+    _, value = as_pattern_set(pattern_data).search(string)
     return value
 
+def add_kv(final, other, key, value, multiple_values=True):
+    """
+    Adds a make_kv result to the walk (final) or other_walk (other) dictionaries
+    """
+    # if no key is returned, the key and value will be the same.
+    if key is None:
+        nkey, nval = value
+        other[nkey].append(nval)
+    else:
+        ## Allows for keys to have multiple values
+        if multiple_values:
+            final[key].append(value)
+        ## Otherwise keys may only have one value
+        else:
+            assert key not in final, key
+            final[key] = value
+
+def manifest_signature(make_kv, make_kv_kw):
+    """
+    Identifies the make_kv settings a manifest was built with;
+    cached results are only reused when the signature is unchanged.
+    """
+    return json.dumps([make_kv.__name__, make_kv_kw], sort_keys=True,
+                      default=lambda obj: getattr(obj, '__name__', str(obj)))
+
+def read_manifest(manifest, signature):
+    """
+    Reads the files from a walk manifest if it exists and matches the signature
+    """
+    if not os.path.isfile(manifest):
+        return {}
+    data = read_dictionary_file(manifest)
+    if data.get('signature') != signature:
+        print(f'{manifest} was built with different walk settings; re-matching all files.')
+        return {}
+    return data['files']
+
+def write_manifest(manifest, signature, files):
+    """
+    Writes the walk manifest to a temporary file and moves it into place
+    """
+    parent = os.path.dirname(manifest)
+    if parent != '':
+        os.makedirs(parent, exist_ok=True)
+    tmp_manifest = f'{manifest}.tmp'
+    with open(tmp_manifest, 'w', encoding='utf-8') as f:
+        json.dump({'signature': signature, 'files': files}, f)
+    os.replace(tmp_manifest, manifest)
+
+def split_other(kv_gen, other):
+    """
+    yields make_kv results that have a key; the rest are added to other
+    """
+    for key, value in kv_gen:
+        if key is None:
+            add_kv(None, other, key, value)
+        else:
+            yield key, value
+
+def walk_kv_gen(roots, make_kv, make_kv_kw, **kwargs):
+    """
+    yields make_kv(root, full_path) for every walked file
+    """
+    for root, data in scandir_file_gen(roots, ignore_list=kwargs.get('ignore_list'),
+                                       max_workers=kwargs.get('max_workers'),
+                                       max_pending=kwargs.get('max_pending')):
+        yield make_kv(root, data, **make_kv_kw)
+
+def manifest_kv_gen(roots, make_kv, make_kv_kw, manifest, changed, deleted, **kwargs):
+    """
+    yields make_kv results like walk_kv_gen, but reuses the manifest for files whose
+    size, mtime and inode are unchanged. New or changed files are added to changed,
+    files that are no longer found are added to deleted, and the manifest is rewritten
+    once the walk is done.
+    """
+    multiple_values = kwargs.get('multiple_values', True)
+    signature = manifest_signature(make_kv, make_kv_kw)
+    previous = read_manifest(manifest, signature)
+    current = {}
+    changed_other = defaultdict(list)
+    for root, (data, identity) in scandir_file_gen(roots, ignore_list=kwargs.get('ignore_list'),
+                                                   max_workers=kwargs.get('max_workers'),
+                                                   with_stat=True,
+                                                   max_pending=kwargs.get('max_pending')):
+        cached = previous.pop(data, None)
+        if identity is not None and cached is not None and cached['identity'] == identity:
+            key, value = cached['key'], cached['value']
+        else:
+            key, value = make_kv(root, data, **make_kv_kw)
+            add_kv(changed, changed_other, key, value, multiple_values)
+        current[data] = {'identity': identity, 'key': key, 'value': value}
+        yield key, value
+
+    ## anything left in the previous manifest was not found on this walk
+    for cached in previous.values():
+        add_kv(deleted, deleted, cached['key'], cached['value'])
+    write_manifest(manifest, signature, current)
+
 def qc_walk(**kwargs):
     """
     Walks a given root and creates key value pairs based on the make_kv function provided.
+    If a manifest path is given, only new or changed files (by size, mtime and inode) are
+    passed to make_kv; the rest reuse the manifest. New or changed and deleted files are
+    also returned under their own keys.
+    If stream is True, the walk output is written to an ndjson file (one line per key)
+    in stream_dir instead of being held in memory. Nodes that read it with
+    dictionary_items() take one line at a time, but node outputs are dictionaries, so
+    the entries that pass the first flag node are held in memory again.
     """
     roots = kwargs.get('roots')
     ignore_list = kwargs.get('ignore_list', [])
@@ -67,31 +168,44 @@ def qc_walk(**kwargs):
     make_kv_kw = kwargs.get('make_kv_kw', {})
     ext = kwargs.get('ext', 'walk')
     multiple_values = kwargs.get('multiple_values', True)
+    max_workers = kwargs.get('max_workers', None)
+    max_pending = kwargs.get('max_pending', None)
+    manifest = kwargs.get('manifest', None)
+    stream = kwargs.get('stream', False)
+    stream_dir = kwargs.get('stream_dir', 'save_log')
+    chunk_size = kwargs.get('chunk_size', 100000)
 
     make_kv_kw.update({'keep_exts': keep_exts})
     if pattern_list:
-        make_kv_kw.update({'pattern_data': pattern_list})
+        ## compile once for the whole walk
+        make_kv_kw.update({'pattern_data': as_pattern_set(pattern_list)})
+
+    walk_kw = {'ignore_list': ignore_list, 'max_workers': max_workers, 'max_pending': max_pending}
+    manifest_outputs = []
+    if manifest is None:
+        kv_gen = walk_kv_gen(roots, make_kv, make_kv_kw, **walk_kw)
+    else:
+        changed = defaultdict(list) if multiple_values else {}
+        deleted = defaultdict(list)
+        kv_gen = manifest_kv_gen(roots, make_kv, make_kv_kw, manifest, changed, deleted,
+                                 multiple_values=multiple_values, **walk_kw)
+        manifest_outputs = [{'final': changed, 'ext': f'changed_{ext}'},
+                            {'final': deleted, 'ext': f'deleted_{ext}'}]
 
-    final = defaultdict(list) if multiple_values else {}
     other = defaultdict(list)
+    if stream:
+        os.makedirs(stream_dir, exist_ok=True)
+        fd, stream_path = tempfile.mkstemp(suffix='.ndjson', dir=stream_dir)
+        os.close(fd)
+        final = write_grouped_ndjson(split_other(kv_gen, other), stream_path,
+                                     chunk_size=chunk_size, multiple_values=multiple_values)
+    else:
+        final = defaultdict(list) if multiple_values else {}
+        for key, value in kv_gen:
+            add_kv(final, other, key, value, multiple_values)
 
-    for root in roots:
-        for data in full_file_gen(root, ignore_list=ignore_list):
-            key, value = make_kv(root, data, **make_kv_kw)
-            # if no key is returned, the key and value will be the same.
-            if key is None:
-                nkey, nval = value
-                other[nkey].append(nval)
-            else:
-                ## Allows for keys to have multiple values
-                if multiple_values:
-                    final[key].append(value)
-                ## Otherwise keys may only have one value
-                else:
-                    assert key not in final, key
-                    final[key] = value
-
-    return [{'final': final, 'ext': ext}, {'final': other, 'ext': f'other_{ext}'}]
+    return [{'final': final, 'ext': ext}, {'final': other, 'ext': f'other_{ext}'}] \
+        + manifest_outputs
 
 def full_file_gen(root, onerror=on_error, topdown=True, ignore_list=None):
     """
@@ -106,3 +220,74 @@ def full_file_gen(root, onerror=on_error, topdown=True, ignore_list=None):
             if os.altsep is not None:
                 full_path = full_path.replace(os.sep, os.altsep)
             yield full_path
+
+
+def file_identity(entry):
+    """
+    [size, mtime_ns, inode] of a scandir entry; None if it cannot be stat'ed
+    """
+    try:
+        stat = entry.stat()
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+def scan_dir(dirpath, ignore_list=None, onerror=on_error, with_stat=False):
+    """
+    Lists one directory with os.scandir; returns the file paths and the paths of the
+    subdirectories not in ignore_list.
+    If with_stat, each file path is returned as (full_path, file_identity).
+    """
+    files, subdirs = [], []
+    ignore_list = ignore_list or ()
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    full_path = entry.path
+                    if os.altsep is not None:
+                        full_path = full_path.replace(os.sep, os.altsep)
+                    files.append((full_path, file_identity(entry)) if with_stat else full_path)
+                ## same as os.walk: symlinked directories are not followed
+                elif entry.name not in ignore_list and not entry.is_symlink():
+                    subdirs.append(entry.path)
+    except OSError as error:
+        if onerror is not None:
+            onerror(error)
+        return files, []
+    return files, subdirs
+
+def scandir_file_gen(roots, onerror=on_error, ignore_list=None, max_workers=None,
+                     with_stat=False, max_pending=None):
+    """
+    Walks every root with a bounded thread pool of os.scandir calls and yields (root, full_path).
+    Paths are yielded in the same (topdown) order as full_file_gen, root by root.
+    At most max_pending directories (default 4 per worker) are listed ahead of the one
+    being yielded, so memory does not grow with the number of folders in the tree.
+    """
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    if max_pending is None:
+        max_pending = 4 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ## [root, dirpath, future or None]; the end of the stack is yielded next
+        stack = [[root, root, None] for root in reversed(roots)]
+        n_pending = 0
+        while stack:
+            ## list the folders that come next, up to max_pending at a time
+            for item in reversed(stack):
+                if n_pending >= max_pending:
+                    break
+                if item[2] is None:
+                    item[2] = executor.submit(scan_dir, item[1], ignore_list, onerror, with_stat)
+                    n_pending += 1
+            root, _, future = stack.pop()
+            n_pending -= 1
+            files, subdirs = future.result()
+            stack.extend([root, subdir, None] for subdir in reversed(subdirs))
+            for full_path in files:
+                yield root, full_path
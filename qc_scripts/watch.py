@@ -0,0 +1,291 @@
+"""
+watch.py
+Watches the walk roots for new files so they can be sent through the QC pipelines as they arrive
+"""
+import os
+import sys
+import copy
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+from collections import defaultdict
+from qc_scripts.walk import scandir_file_gen, match_filename_format, add_kv
+
+## inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+def get_identity(path):
+    """
+    [size, mtime_ns, inode] of a file; None if it cannot be stat'ed
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+class PollingWatcher:
+    """
+    Finds new, changed and removed files by re-walking the roots every poll_interval seconds.
+    A file is only reported once its size, mtime and inode are the same on two polls in a row,
+    so files that are still being uploaded are not picked up early.
+    """
+    def __init__(self, roots, ignore_list=None, **kwargs):
+        self.roots = roots
+        self.ignore_list = ignore_list or []
+        self.max_workers = kwargs.get('max_workers', None)
+        self.poll_interval = kwargs.get('poll_interval', 5)
+        self.known = {} ## full_path -> (root, identity)
+        self.pending = {} ## full_path -> identity, waiting to settle
+
+    def scan(self):
+        """
+        {full_path: (root, identity)} for every file under the roots
+        """
+        return {path: (root, identity) for root, (path, identity)
+                in scandir_file_gen(self.roots, ignore_list=self.ignore_list,
+                                    max_workers=self.max_workers, with_stat=True)}
+
+    def start(self):
+        """
+        records the files already under the roots and returns them as (root, full_path)
+        """
+        self.known = self.scan()
+        return [(root, path) for path, (root, _) in self.known.items()]
+
+    def diff(self, current, settle=True):
+        """
+        compares a scan to the known files; returns (added, removed)
+        """
+        added = []
+        for path, (root, identity) in current.items():
+            known = self.known.get(path)
+            if known is not None and known[1] == identity:
+                continue
+            if settle and self.pending.get(path) != identity:
+                self.pending[path] = identity
+                continue
+            self.pending.pop(path, None)
+            self.known[path] = (root, identity)
+            added.append((root, path))
+        removed = [path for path in self.known if path not in current]
+        for path in removed:
+            del self.known[path]
+        self.pending = {path: identity for path, identity in self.pending.items()
+                        if path in current}
+        return added, removed
+
+    def poll(self, timeout=None):
+        """
+        waits up to timeout seconds (poll_interval if None) and returns (added, removed)
+        """
+        interval = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        time.sleep(interval)
+        return self.diff(self.scan())
+
+    def close(self):
+        """
+        nothing to release when polling
+        """
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Linux inotify watcher (through ctypes, no extra dependencies).
+    Files are reported once they are closed after writing or moved into a watched folder.
+    New subdirectories are watched as they are created; if the kernel event queue
+    overflows, the roots are re-walked instead.
+    """
+    def __init__(self, roots, ignore_list=None, **kwargs):
+        super().__init__(roots, ignore_list, **kwargs)
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(f'{libc_name} does not support inotify')
+        self.fd = self.libc.inotify_init1(0)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {} ## watch descriptor -> (root, dirpath)
+
+    def add_watch(self, root, dirpath):
+        """
+        watch a single directory
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            print(f'Unable to watch {dirpath}: {os.strerror(errno)}')
+            return
+        self.watches[wd] = (root, dirpath)
+
+    def watch_tree(self, root, top):
+        """
+        watches top and its subdirectories (minus the ignore_list);
+        returns the files found as (root, full_path)
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if d not in self.ignore_list]
+            ## watch before listing so files created in between are not missed
+            self.add_watch(root, dirpath)
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                self.known[path] = (root, get_identity(path))
+                files.append((root, path))
+        return files
+
+    def start(self):
+        files = []
+        for root in self.roots:
+            files.extend(self.watch_tree(root, root))
+        return files
+
+    def poll(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return [], []
+        data = os.read(self.fd, 64 * 1024)
+        added, removed = [], []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                more_added, more_removed = self.diff(self.scan(), settle=False)
+                added.extend(more_added)
+                removed.extend(more_removed)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            root, dirpath = self.watches[wd]
+            path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name not in self.ignore_list:
+                    added.extend(self.watch_tree(root, path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.known[path] = (root, get_identity(path))
+                added.append((root, path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.known.pop(path, None)
+                removed.append(path)
+        return added, removed
+
+    def close(self):
+        os.close(self.fd)
+
+def get_watcher(roots, **kwargs):
+    """
+    inotify on Linux, polling everywhere else or if inotify cannot be set up
+    """
+    if sys.platform.startswith('linux') and kwargs.get('use_inotify', True):
+        try:
+            return InotifyWatcher(roots, **kwargs)
+        except OSError as error:
+            print(f'inotify is unavailable ({error}); polling instead.')
+    return PollingWatcher(roots, **kwargs)
+
+def micro_batches(watcher, batch_window=5, max_batch_size=1000):
+    """
+    yields (added, removed) batches forever: waits for the first change, then keeps
+    collecting for batch_window seconds or until max_batch_size files are added
+    """
+    while True:
+        added, removed = watcher.poll()
+        if len(added) == 0 and len(removed) == 0:
+            continue
+        deadline = time.monotonic() + batch_window
+        while len(added) < max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more_added, more_removed = watcher.poll(remaining)
+            added.extend(more_added)
+            removed.extend(more_removed)
+        yield added, removed
+
+class WalkIndex:
+    """
+    make_kv results for every file under the roots, grouped by key (id_date),
+    so a batch can be sent through the pipelines with the whole id_date group of each new file
+    """
+    def __init__(self, make_kv=match_filename_format, make_kv_kw=None):
+        self.make_kv = make_kv
+        self.make_kv_kw = make_kv_kw or {}
+        self.keys = {} ## full_path -> key
+        self.groups = defaultdict(dict) ## key -> {full_path: value}
+
+    def __repr__(self):
+        return f'WalkIndex({len(self.keys)} files, {len(self.groups)} keys)'
+
+    def remove(self, path):
+        """
+        drop a file from the index
+        """
+        key = self.keys.pop(path, None)
+        if key is not None:
+            self.groups[key].pop(path, None)
+            if len(self.groups[key]) == 0:
+                del self.groups[key]
+
+    def update(self, added, removed):
+        """
+        applies a batch of changes;
+        returns the keys touched by added files and the added files without a key (other)
+        """
+        for path in removed:
+            self.remove(path)
+        touched = set()
+        other = defaultdict(list)
+        for root, path in added:
+            self.remove(path)
+            key, value = self.make_kv(root, path, **self.make_kv_kw)
+            if key is None:
+                add_kv(None, other, key, value)
+                continue
+            self.keys[path] = key
+            self.groups[key][path] = value
+            touched.add(key)
+        return touched, other
+
+    def get_groups(self, keys):
+        """
+        {key: [values]} for the given keys, skipping files that have since been moved;
+        values are copies since the pipelines edit them in place
+        """
+        final = {}
+        for key in sorted(keys):
+            values = [copy.deepcopy(value) for path, value in self.groups.get(key, {}).items()
+                      if os.path.isfile(path)]
+            if len(values) > 0:
+                final[key] = values
+        return final
+
+def watch_walk(**kwargs):
+    """
+    SourceNode function for one watch batch;
+    returns the walk output for the id_date groups of the added files
+    """
+    index = kwargs.get('index')
+    added = kwargs.get('added', [])
+    removed = kwargs.get('removed', [])
+    ext = kwargs.get('ext', 'walk')
+
+    touched, other = index.update(added, removed)
+    return [{'final': index.get_groups(touched), 'ext': ext},
+            {'final': other, 'ext': f'other_{ext}'}]
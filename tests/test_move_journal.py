@@ -0,0 +1,70 @@
+"""
+test_move_journal.py
+Resuming and rolling back journaled moves
+"""
+import os
+import pytest
+from qc_scripts.move import move_files
+from qc_scripts.utility.move_commands import native_move
+from qc_scripts.utility.move_journal import MoveJournal, rollback_journal
+
+def make_data(tmp_path, names):
+    """
+    {id_date: entry} with one small file per name in tmp_path/src
+    """
+    data = {}
+    for name in names:
+        src = tmp_path / 'src' / f'{name}.wav'
+        src.parent.mkdir(parents=True, exist_ok=True)
+        src.write_bytes(name.encode('utf-8'))
+        data[name] = {'src': str(src), 'dst': str(tmp_path / 'dst' / f'{name}.wav')}
+    return data
+
+def interrupted_move(fail_on):
+    """
+    native_move that raises (like an interrupted run) when it gets to fail_on
+    """
+    def move_function(src, dst, **kwargs):
+        if os.path.basename(src) == fail_on:
+            raise KeyboardInterrupt
+        return native_move(src, dst, **kwargs)
+    return move_function
+
+def statuses(output):
+    """
+    {src: status} of a move_files output
+    """
+    return {value['src']: value['status'] for values in output[0]['final'].values()
+            for value in values}
+
+def test_resume_after_rollback_moves_again(tmp_path):
+    data = make_data(tmp_path, ['a', 'b'])
+    journal = str(tmp_path / 'journal.ndjson')
+    src_a, dst_a = data['a']['src'], data['a']['dst']
+
+    with pytest.raises(KeyboardInterrupt):
+        move_files(data, journal=journal, max_workers=1, move_function=interrupted_move('b.wav'))
+    assert os.path.isfile(dst_a) and not os.path.isfile(src_a)
+    assert not MoveJournal(journal).state()[3]
+
+    rollback_journal(journal=journal)
+    assert os.path.isfile(src_a) and not os.path.isfile(dst_a)
+
+    output = move_files(data, journal=journal, max_workers=1)
+    assert os.path.isfile(dst_a) and not os.path.isfile(src_a)
+    assert statuses(output)[src_a] == 'only_dst_exists'
+
+def test_second_rollback_after_a_move_again(tmp_path):
+    data = make_data(tmp_path, ['a', 'b'])
+    journal = str(tmp_path / 'journal.ndjson')
+    src_a, dst_a = data['a']['src'], data['a']['dst']
+
+    with pytest.raises(KeyboardInterrupt):
+        move_files(data, journal=journal, max_workers=1, move_function=interrupted_move('b.wav'))
+    rollback_journal(journal=journal)
+    with pytest.raises(KeyboardInterrupt):
+        move_files(data, journal=journal, max_workers=1, move_function=interrupted_move('b.wav'))
+    assert os.path.isfile(dst_a)
+
+    rollback_journal(journal=journal)
+    assert os.path.isfile(src_a) and not os.path.isfile(dst_a)